@@ -0,0 +1,193 @@
+"""Offline benchmarks of the sticker converters.
+
+Generates synthetic WebP and TGS stickers in a range of sizes and frame counts, then measures
+per-sticker latency, throughput and peak memory of _convert_image, _convert_animation,
+_process_sticker and of the conversion pool used by TelegramExporter.
+
+Every result is printed as one json line, so runs can be stored and compared over time:
+    python benchmarks/conversion.py --output bench.jsonl
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stickerbridge'))
+
+import lottie
+import PIL
+from lottie import Color, NVector, objects
+from lottie.exporters.core import export_tgs
+from PIL import Image, ImageDraw
+from telethon.tl.types import Document, DocumentAttributeImageSize, DocumentAttributeSticker, InputStickerSetEmpty
+
+import telegram_exporter
+from telegram_exporter import TelegramExporter
+
+IMAGE_SIZES = [128, 256, 512, 1024]
+ANIMATION_FRAMES = [30, 60, 120, 180]
+
+
+def make_webp(size: int, seed: int = 0) -> bytes:
+    """Concentric rings, a different seed gives a different image"""
+    image = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for i in range(0, size, max(1, size // 16)):
+        draw.ellipse((i // 2, i // 2, size - i // 2, size - i // 2), outline=(i % 256, (128 + seed) % 256, 255 - i % 256, 255), width=3)
+    if seed:
+        draw.text((size // 3, size // 3), str(seed), fill=(255, 255, 255, 255))
+    out = BytesIO()
+    image.save(out, "webp")
+    return out.getvalue()
+
+
+def make_tgs(frames: int) -> bytes:
+    animation = objects.Animation(frames - 1, 60)
+    animation.width = animation.height = 512
+    layer = objects.ShapeLayer()
+    animation.add_layer(layer)
+    group = layer.add_shape(objects.Group())
+    group.add_shape(objects.Ellipse(NVector(256, 256), NVector(200, 200)))
+    group.add_shape(objects.Rect(NVector(256, 256), NVector(120, 120)))
+    group.add_shape(objects.Fill(Color(1, 0.5, 0)))
+    group.transform.rotation.add_keyframe(0, 0)
+    group.transform.rotation.add_keyframe(frames - 1, 360)
+    out = BytesIO()
+    export_tgs(animation, out)
+    return out.getvalue()
+
+
+def make_document(document_id: int, mime_type: str, data: bytes) -> Document:
+    document = Document(
+        id=document_id, access_hash=0, file_reference=b'', date=datetime.datetime.now(), mime_type=mime_type,
+        size=len(data), dc_id=0,
+        attributes=[DocumentAttributeImageSize(512, 512), DocumentAttributeSticker(alt="🙂", stickerset=InputStickerSetEmpty())],
+    )
+    document.downloaded_data_ = data
+    return document
+
+
+def fixtures() -> list[tuple[str, Document]]:
+    result = []
+    for size in IMAGE_SIZES:
+        result.append((f"webp-{size}px", make_document(len(result), "image/webp", make_webp(size))))
+    for frames in ANIMATION_FRAMES:
+        result.append((f"tgs-{frames}f", make_document(len(result), "application/x-tgsticker", make_tgs(frames))))
+    return result
+
+
+def measure(func, *args, repeat: int) -> dict:
+    latencies = []
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        started = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - started)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {
+        "runs": repeat,
+        "latency_median_s": statistics.median(latencies),
+        "latency_p95_s": statistics.quantiles(latencies, n=20, method="inclusive")[-1] if repeat > 1 else latencies[0],
+        "latency_max_s": max(latencies),
+        "throughput_per_s": repeat / sum(latencies),
+        "peak_python_memory_bytes": peak,
+    }
+
+
+async def measure_pool(documents: list[Document], workers: int, repeat: int, frame_chunk_size: int) -> dict:
+    # the exporter never connects, the pool is started on its own
+    session = tempfile.TemporaryDirectory()
+    exporter = TelegramExporter(1, "benchmark", "", os.path.join(session.name, "benchmark"),
+                                conversion_workers=workers, frame_chunk_size=frame_chunk_size)
+    exporter.start_pool()
+    # first round only warms up the workers
+    await asyncio.gather(*[exporter._convert_document(document) for document in documents])
+
+    started = time.perf_counter()
+    converted = 0
+    for _ in range(repeat):
+        results = await asyncio.gather(*[exporter._convert_document(document) for document in documents])
+        converted += len([result for result in results if result is not None])
+    elapsed = time.perf_counter() - started
+    await exporter.close()
+    session.cleanup()
+
+    return {
+        "runs": repeat,
+        "stickers": len(documents) * repeat,
+        "converted": converted,
+        "wall_time_s": elapsed,
+        "throughput_per_s": converted / elapsed if elapsed else 0,
+        "peak_worker_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def cairosvg_version() -> str:
+    try:
+        import cairosvg
+        return cairosvg.__version__
+    except (ImportError, OSError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', '-n', type=int, default=5, help='Runs of every measurement')
+    parser.add_argument('--workers', '-w', type=int, default=None, help='Conversion pool size, defaults to all cores')
+    parser.add_argument('--frame-chunk-size', type=int, default=0, help='Frame chunk size used for the pool benchmark')
+    parser.add_argument('--output', '-o', type=str, help='Append results to this file instead of printing them')
+    args = parser.parse_args()
+
+    run = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "lottie": lottie.__version__,
+        "cairosvg": cairosvg_version(),
+        "cpu_count": os.cpu_count(),
+    }
+    output = open(args.output, "a") if args.output else sys.stdout
+
+    def report(benchmark: str, fixture: str, result: dict):
+        output.write(json.dumps({**run, "benchmark": benchmark, "fixture": fixture, **result}) + "\n")
+        output.flush()
+
+    documents = fixtures()
+    for name, document in documents:
+        data = document.downloaded_data_
+        if document.mime_type == "image/webp":
+            paths = [("_convert_image", telegram_exporter._convert_image, (data,))]
+        else:
+            paths = [("_convert_animation", telegram_exporter._convert_animation, (data,))]
+        paths.append(("_process_sticker", telegram_exporter._process_sticker, (document,)))
+
+        for benchmark, func, func_args in paths:
+            try:
+                result = measure(func, *func_args, repeat=args.repeat)
+            except Exception as e:
+                result = {"error": f"{type(e).__name__}: {e}"}
+            report(benchmark, name, {"input_bytes": len(data), **result})
+
+    for name, selected in [("static", [d for _, d in documents if d.mime_type == "image/webp"]),
+                           ("animated", [d for _, d in documents if d.mime_type != "image/webp"])]:
+        result = asyncio.run(measure_pool(selected, args.workers, args.repeat, args.frame_chunk_size))
+        report("pool", name, {"workers": args.workers or os.cpu_count(), "frame_chunk_size": args.frame_chunk_size,
+                              **result})
+
+    if args.output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
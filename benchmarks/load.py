@@ -0,0 +1,443 @@
+"""End-to-end load test of the bot without network access.
+
+Starts a local stand-in Matrix homeserver and replaces the Telegram connection with a stub serving generated
+sticker sets, then imports many packs at once, either as "!sb import" commands sent to Callbacks.message
+or as an import-batch of cli.py. Reports throughput, latency percentiles of every stage and the number of
+requests the homeserver received:
+    python benchmarks/load.py --mode bot --packs 8 --stickers 30 --output load.json
+"""
+import argparse
+import asyncio
+import copy
+import datetime
+import itertools
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'stickerbridge'))
+
+import yaml
+from aiohttp import web
+from nio import AsyncClient, MatrixRoom, RoomMessageText, SyncResponse
+from telethon.errors import StickersetInvalidError
+from telethon.tl.functions.messages import GetStickerSetRequest
+from telethon.tl.types.messages import StickerSetNotModified
+
+import cli
+from callbacks import Callbacks
+from config import Config
+from conversion import make_document, make_tgs, make_webp
+from job_scheduler import JobScheduler
+from media_index import MediaIndex
+from sync_token import SyncTokenStore
+
+BOT_USER = "@stickerbridge:localhost"
+
+
+class StageTimes:
+    """Collects durations of the import stages"""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+
+    def wrap(self, stage: str, func):
+        async def _timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.durations[stage].append(time.perf_counter() - started)
+        return _timed
+
+    def report(self) -> dict:
+        result = {}
+        for stage, durations in self.durations.items():
+            quantiles = statistics.quantiles(durations, n=100, method="inclusive") if len(durations) > 1 else durations * 99
+            result[stage] = {
+                "count": len(durations),
+                "p50_s": quantiles[49],
+                "p90_s": quantiles[89],
+                "p99_s": quantiles[98],
+                "max_s": max(durations),
+            }
+        return result
+
+
+class FakeHomeserver:
+    """Implements the client-server endpoints used by the bot and the cli, keeping room state in memory"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests = Counter()
+        self.rooms = {}
+        self.aliases = {}
+        self.uploaded_bytes = 0
+        self.media = {}
+        self._ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    def add_room(self, alias: str = None) -> str:
+        room_id = f"!room{next(self._ids)}:localhost"
+        self.rooms[room_id] = {
+            ("m.room.create", ""): {"creator": BOT_USER},
+            ("m.room.power_levels", ""): {"users": {BOT_USER: 100}, "users_default": 0, "state_default": 50,
+                                          "events_default": 0},
+        }
+        if alias is not None:
+            self.aliases[alias] = room_id
+        return room_id
+
+    @web.middleware
+    async def _count(self, request: web.Request, handler):
+        self.requests[f"{request.method} {request.match_info.route.resource.canonical}"] += 1
+        if self.latency and not request.path.endswith("/sync"):
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    @staticmethod
+    def _not_found(message: str) -> web.Response:
+        return web.json_response({"errcode": "M_NOT_FOUND", "error": message}, status=404)
+
+    async def _upload(self, request: web.Request):
+        data = await request.read()
+        self.uploaded_bytes += len(data)
+        media_id = f"media{next(self._ids)}"
+        self.media[media_id] = (data, request.content_type)
+        return web.json_response({"content_uri": f"mxc://localhost/{media_id}"})
+
+    async def _download(self, request: web.Request):
+        if request.match_info["media_id"] not in self.media:
+            return self._not_found("Unknown media")
+        data, content_type = self.media[request.match_info["media_id"]]
+        return web.Response(body=data, content_type=content_type)
+
+    async def _get_state(self, request: web.Request):
+        room = self.rooms.get(request.match_info["room_id"], None)
+        if room is None:
+            return self._not_found("Unknown room")
+        if "event_type" not in request.match_info:
+            return web.json_response([{"type": event_type, "state_key": state_key, "content": content,
+                                       "sender": BOT_USER, "event_id": f"$state{next(self._ids)}",
+                                       "origin_server_ts": 0}
+                                      for (event_type, state_key), content in room.items()])
+        content = room.get((request.match_info["event_type"], request.match_info.get("state_key", "")), None)
+        if content is None:
+            return self._not_found("Event not found")
+        return web.json_response(content)
+
+    async def _put_state(self, request: web.Request):
+        room = self.rooms.get(request.match_info["room_id"], None)
+        if room is None:
+            return self._not_found("Unknown room")
+        room[(request.match_info["event_type"], request.match_info.get("state_key", ""))] = await request.json()
+        return web.json_response({"event_id": f"$state{next(self._ids)}"})
+
+    async def _send(self, request: web.Request):
+        await request.read()
+        return web.json_response({"event_id": f"$event{next(self._ids)}"})
+
+    async def _resolve_alias(self, request: web.Request):
+        room_id = self.aliases.get(request.match_info["alias"], None)
+        if room_id is None:
+            return self._not_found("Room alias not found")
+        return web.json_response({"room_id": room_id, "servers": ["localhost"]})
+
+    async def _create_room(self, request: web.Request):
+        body = await request.json()
+        alias = f"#{body['room_alias_name']}:localhost" if body.get("room_alias_name", None) else None
+        room_id = self.add_room(alias)
+        for event in body.get("initial_state", []):
+            self.rooms[room_id][(event["type"], event.get("state_key", ""))] = event["content"]
+        return web.json_response({"room_id": room_id})
+
+    async def _sync(self, request: web.Request):
+        # long polling without new events
+        timeout = int(request.query.get("timeout", 0)) / 1000
+        if timeout:
+            await asyncio.sleep(min(timeout, 1))
+        return web.json_response({"next_batch": f"s{next(self._ids)}", "rooms": {"join": {}, "invite": {}, "leave": {}}})
+
+    async def _whoami(self, request: web.Request):
+        return web.json_response({"user_id": BOT_USER})
+
+    async def _joined_rooms(self, request: web.Request):
+        return web.json_response({"joined_rooms": list(self.rooms)})
+
+    async def start(self):
+        app = web.Application(middlewares=[self._count], client_max_size=64 * 1024 * 1024)
+        client_path = "/_matrix/client/v3"
+        state_path = client_path + "/rooms/{room_id}/state"
+        app.add_routes([
+            web.post("/_matrix/media/v3/upload", self._upload),
+            web.get("/_matrix/client/v1/media/download/{server_name}/{media_id}", self._download),
+            web.get(state_path, self._get_state),
+            web.get(state_path + "/{event_type}", self._get_state),
+            web.get(state_path + "/{event_type}/{state_key:.*}", self._get_state),
+            web.put(state_path + "/{event_type}", self._put_state),
+            web.put(state_path + "/{event_type}/{state_key:.*}", self._put_state),
+            web.put(client_path + "/rooms/{room_id}/send/{event_type}/{txn_id}", self._send),
+            web.get(client_path + "/directory/room/{alias}", self._resolve_alias),
+            web.post(client_path + "/createRoom", self._create_room),
+            web.get(client_path + "/sync", self._sync),
+            web.get(client_path + "/account/whoami", self._whoami),
+            web.get(client_path + "/joined_rooms", self._joined_rooms),
+        ])
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def close(self):
+        await self._runner.cleanup()
+
+
+class StubTelegram:
+    """Stands in for the telethon client of TelegramExporter, serving generated sticker sets"""
+
+    def __init__(self, packs: dict[str, list], latency: float):
+        self.packs = packs
+        self.latency = latency
+        self.requests = Counter()
+        self.data = {document.id: document.downloaded_data_ for documents in packs.values() for document in documents}
+
+    async def start(self, bot_token: str = None):
+        return self
+
+    async def disconnect(self):
+        pass
+
+    async def __call__(self, request):
+        return await self.get_sticker_set(request)
+
+    async def get_sticker_set(self, request):
+        self.requests[type(request).__name__] += 1
+        await asyncio.sleep(self.latency)
+        if not isinstance(request, GetStickerSetRequest):
+            raise NotImplementedError(type(request).__name__)
+        pack_name = getattr(request.stickerset, "short_name", None)
+        if pack_name not in self.packs:
+            raise StickersetInvalidError(request)
+        set_hash = hash(pack_name) & 0x7fffffff
+        if request.hash == set_hash:
+            return StickerSetNotModified()
+        # like telethon, every response has its own document objects, even for stickers shared between packs
+        documents = [copy.copy(document) for document in self.packs[pack_name]]
+        return SimpleNamespace(set=SimpleNamespace(hash=set_hash, short_name=pack_name), documents=documents)
+
+    async def download_media(self, document, file=bytes):
+        self.requests["download_media"] += 1
+        await asyncio.sleep(self.latency)
+        if file is not bytes:
+            with open(file, 'wb') as f:
+                f.write(self.data[document.id])
+            return file
+        return self.data[document.id]
+
+
+def make_packs(count: int, stickers: int, size: int, animated: float, shared: float) -> dict[str, list]:
+    """Generate packs, a share of the stickers is the same in every pack to exercise deduplication"""
+    ids = itertools.count(1)
+    shared_documents = [make_document(next(ids), "image/webp", make_webp(size, seed=i + 1))
+                        for i in range(int(stickers * shared))]
+    animated_count = int(stickers * animated)
+    packs = {}
+    for pack in range(count):
+        documents = list(shared_documents)
+        while len(documents) < stickers:
+            document_id = next(ids)
+            if len(documents) < len(shared_documents) + animated_count:
+                documents.append(make_document(document_id, "application/x-tgsticker", make_tgs(30 + document_id % 60)))
+            else:
+                documents.append(make_document(document_id, "image/webp", make_webp(size, seed=document_id)))
+        packs[f"loadpack{pack}"] = documents
+    return packs
+
+
+def make_config(homeserver: FakeHomeserver, args: argparse.Namespace) -> tuple[Config, dict]:
+    with open(os.path.join(ROOT, 'config.yaml.example'), 'r') as config_file:
+        config = yaml.safe_load(config_file)
+    config.update({
+        "matrix_homeserver": homeserver.url,
+        "matrix_username": BOT_USER,
+        "matrix_login_type": "access_token",
+        "max_concurrent_jobs": args.parallel,
+        "log_level": "WARNING",
+    })
+    config["conversion"].update({"workers": args.workers, "cache_max_size_mb": 512 if args.cache else 0,
+                                 "spool_directory": "data/spool" if args.spool else None})
+    with open(os.path.join(ROOT, 'cli.yaml.example'), 'r') as config_file:
+        cli_config = yaml.safe_load(config_file)
+    cli_config["room"]["homeserver"] = "localhost"
+    cli_config["import"]["batch_parallel"] = args.parallel
+
+    # written to the working directory like a real config, so it is validated the same way
+    with open('config.yaml', 'w') as config_file:
+        yaml.safe_dump(config, config_file)
+    return Config('config.yaml'), cli_config
+
+
+async def run_bot(client: AsyncClient, callbacks: Callbacks, rooms: dict[str, MatrixRoom], stages: StageTimes,
+                  trace: bool):
+    """Send one import command per pack, each in its own room, the way they would arrive from sync"""
+    syncing = asyncio.ensure_future(client.sync_forever(1000))
+
+    finished = asyncio.Semaphore(0)
+    process_command = stages.wrap("import", Callbacks._process_command)
+
+    async def _process_command(room, command):
+        try:
+            await process_command(callbacks, room, command)
+        finally:
+            finished.release()
+
+    callbacks._process_command = _process_command
+
+    for pack_name, room in rooms.items():
+        event = RoomMessageText.from_dict({
+            "type": "m.room.message", "event_id": f"$command{room.room_id}", "sender": "@user:localhost",
+            "origin_server_ts": int(time.time() * 1000),
+            "content": {"msgtype": "m.text",
+                        "body": f"{callbacks.command_prefix} import {pack_name}" + (" --trace" if trace else "")},
+        })
+        await callbacks.message(room, event)
+    for _ in rooms:
+        await finished.acquire()
+
+    syncing.cancel()
+    await asyncio.gather(syncing, return_exceptions=True)
+
+
+async def run_cli(client: AsyncClient, media_index: MediaIndex, config: Config, cli_config: dict, pack_names: list[str],
+                  trace: bool):
+    """Import every pack with the import-batch command, rooms are created by the cli"""
+    with open('manifest.yaml', 'w') as manifest_file:
+        yaml.safe_dump({"packs": [{"pack": pack_name} for pack_name in pack_names]}, manifest_file)
+
+    args = argparse.Namespace(manifest='manifest.yaml', parallel=config['max_concurrent_jobs'], create_room=True,
+                              trace=trace)
+    await cli.import_batch(args, client, config, cli_config, media_index)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    homeserver = FakeHomeserver(args.homeserver_latency / 1000)
+    await homeserver.start()
+    config, cli_config = make_config(homeserver, args)
+
+    packs = make_packs(args.packs, args.stickers, args.size, args.animated, args.shared)
+    telegram = StubTelegram(packs, args.telegram_latency / 1000)
+    exporter = cli.create_exporter(config)
+    exporter.client.session.close()
+    exporter.client = telegram
+
+    client = AsyncClient(homeserver.url, BOT_USER)
+    client.restore_login(BOT_USER, "LOADTEST", "token")
+    media_index = MediaIndex('data/media_index.db')
+
+    stages = StageTimes()
+    telegram.get_sticker_set = stages.wrap("telegram_stickerset", telegram.get_sticker_set)
+    telegram.download_media = stages.wrap("download", telegram.download_media)
+    exporter._convert_document = stages.wrap("convert", exporter._convert_document)
+    client.upload = stages.wrap("upload", client.upload)
+    client.room_put_state = stages.wrap("room_state", client.room_put_state)
+
+    if args.mode == "bot":
+        await exporter.connect()
+        scheduler = JobScheduler(config['max_concurrent_jobs'])
+        sync_token = SyncTokenStore('data/next_batch', config['sync_token_save_interval'])
+        callbacks = Callbacks(client, config['command_prefix'], config, exporter, media_index, scheduler, sync_token)
+        client.add_response_callback(callbacks.sync, SyncResponse)
+        rooms = {pack_name: MatrixRoom(homeserver.add_room(), BOT_USER) for pack_name in packs}
+    else:
+        # import-batch connects and closes the exporter itself
+        cli.create_exporter = lambda config: exporter
+        cli.run_import = stages.wrap("import", cli.run_import)
+
+    rounds = []
+    for _ in range(args.rounds):
+        started = time.perf_counter()
+        if args.mode == "bot":
+            await run_bot(client, callbacks, rooms, stages, bool(args.trace))
+        else:
+            await run_cli(client, media_index, config, cli_config, list(packs), bool(args.trace))
+        elapsed = time.perf_counter() - started
+        rounds.append({
+            "wall_time_s": elapsed,
+            "packs_per_s": len(packs) / elapsed,
+            "stickers_per_s": sum(len(documents) for documents in packs.values()) / elapsed,
+        })
+
+    if args.mode == "bot":
+        await sync_token.close()
+        await scheduler.close()
+        await exporter.close()
+    media_index.close()
+    await client.close()
+    await homeserver.close()
+
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "rounds": rounds,
+        "stages": stages.report(),
+        "homeserver_requests": dict(homeserver.requests.most_common()),
+        "homeserver_uploaded_bytes": homeserver.uploaded_bytes,
+        "telegram_requests": dict(telegram.requests),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('bot', 'cli'), default='bot',
+                        help='Send commands to the bot callbacks, or run an import-batch of the cli')
+    parser.add_argument('--packs', '-n', type=int, default=4, help='Number of packs imported at once')
+    parser.add_argument('--stickers', '-s', type=int, default=20, help='Stickers in every pack')
+    parser.add_argument('--size', type=int, default=512, help='Size of the generated static stickers')
+    parser.add_argument('--animated', type=float, default=0, help='Share of animated stickers in every pack')
+    parser.add_argument('--shared', type=float, default=0.25, help='Share of stickers that are the same in every pack')
+    parser.add_argument('--parallel', '-P', type=int, default=2, help='Imports running at the same time')
+    parser.add_argument('--workers', '-w', type=int, default=None, help='Conversion pool size, defaults to all cores')
+    parser.add_argument('--cache', action='store_true', help='Use the converted sticker cache')
+    parser.add_argument('--spool', action='store_true', help='Spool downloads to disk instead of memory')
+    parser.add_argument('--rounds', type=int, default=1, help='Import every pack this many times, later rounds update the packs')
+    parser.add_argument('--homeserver-latency', type=float, default=5, help='Milliseconds added to every homeserver request')
+    parser.add_argument('--telegram-latency', type=float, default=20, help='Milliseconds added to every Telegram request')
+    parser.add_argument('--trace', type=str, help='Also write the import traces of every pack to this directory')
+    parser.add_argument('--output', '-o', type=str, help='Write the report to this file instead of printing it')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    traces = os.path.abspath(args.trace) if args.trace else None
+
+    # the bot keeps its state in data/ of the working directory
+    directory = tempfile.mkdtemp(prefix='stickerbridge-load-')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    os.makedirs('data')
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if traces and os.path.exists(os.path.join(directory, 'data', 'traces')):
+            shutil.copytree(os.path.join(directory, 'data', 'traces'), traces, dirs_exist_ok=True)
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
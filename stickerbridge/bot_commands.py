@@ -1,7 +1,11 @@
+from collections.abc import Mapping
+
 from nio import AsyncClient, MatrixRoom
 
+from config import DEFAULTS
 from chat_functions import send_text_to_room
 from matrix_reuploader import MatrixReuploader
+from media_index import MediaIndex
 from matrix_preview import MatrixPreview
 from telegram_exporter import TelegramExporter
 
@@ -53,13 +57,20 @@ class Command:
         room: MatrixRoom,
         command: str,
         tg_exporter: TelegramExporter,
+        media_index: MediaIndex = None,
+        config: Mapping = None,
     ):
         self.client = client
         self.room = room
         self.command = command.lower()
         self.tg_exporter = tg_exporter
+        self.media_index = media_index
+        self.config = config if config is not None else DEFAULTS
         self.args = command.split()[1:]
 
+    def is_long_running(self) -> bool:
+        return self.command.startswith(("import", "preview"))
+
     async def process(self):
         if self.command.startswith("help"):
             await self._show_help()
@@ -83,6 +94,7 @@ class Command:
             "\t\t-au | --artist-url <artist_url> - Use this flag if you want to add artist url to json file\n"
             "\t\t-r  | --rating <safe|questionable|explicit|s|q|e|sfw|nsfw> - Use this flag if you want add rating to json file\n"
             "\t\t-upd | --update-room - Update pack if it already exists\n"
+            "\t\t-t  | --trace - Write timings of every import stage to data/traces for finding out why an import is slow\n"
             "\t\tIF boolean flags are true in config, and are provided, they are applied as a False.\n"
             "preview [pack_name] - Use this to create a preview for a Telegram stickers. If pack_name is not provided, then preview is generated for a primary pack.\n"
             "\tFlags:\n"
@@ -92,6 +104,7 @@ class Command:
             "\t\t-s | --space [#space:homeserver] - Use this flag if you want to include space name in the room topic\n"
             "\t\t-pu | --preview-url [website_url] - Use this flag if you want to include stickerpack preview url in the room topic\n"
             "\t\t-upd | --update-room - Use this flag if you want to update room avatar, name and topic\n"
+            "\t\t-cs | --contact-sheet - Send one grid image of the pack instead of separate stickers, also used as the room avatar\n"
             "\t\tIF flags are provided, without parameters, then parameters are taken from the pack content if were provided on import or config!\n"
             "\t\tIF boolean flags are true in config, and are provided, they are applied as a False.\n"
         )
@@ -117,10 +130,12 @@ class Command:
         #       -a  | --artist <artist> - Use this flag if you want to include stickerpack artist to json file
         #       -au | --artist-url <artist_url> - Use this flag if you want to add artist url to json file
         #       -r  | --rating <safe|questionable|explicit|s|q|e|sfw|nsfw> - Use this flag if you want add rating to json file
+        #       -t  | --trace - Write timings of every import stage to data/traces
         #       IF boolean flags are true in config, and are provided, they are applied as a False.
         #
 
-        reuploader = MatrixReuploader(self.client, self.room, exporter=self.tg_exporter)
+        reuploader = MatrixReuploader(self.client, self.room, exporter=self.tg_exporter, media_index=self.media_index,
+                                      upload_concurrency=self.config['matrix_upload_concurrency'], config=self.config)
         async for status in reuploader.import_stickerset_to_room(
             pack_name, import_name, flags
         ):
@@ -140,6 +155,17 @@ class Command:
                 MatrixReuploader.STATUS_PACK_UPDATE: (
                     f"Updating Stickerpack '{pack_name}'.\n"
                 ),
+                MatrixReuploader.STATUS_PACK_UNCHANGED: (
+                    f"Stickerpack '{pack_name}' is already up to date."
+                ),
+                MatrixReuploader.STATUS_CONVERSION_FALLBACK: (
+                    f"Warning: some animated stickers of '{pack_name}' took too long to convert and were imported as a static image.\n"
+                    "Update the pack later to convert them again."
+                ),
+                MatrixReuploader.STATUS_STICKERS_SKIPPED: (
+                    f"Warning: some stickers of '{pack_name}' failed to download, convert or upload and were left out.\n"
+                    "Update the pack later to import them again."
+                ),
                 MatrixReuploader.STATUS_PACK_EMPTY: (
                     f"Warning: Telegram pack {pack_name} find out empty or not existing."
                 ),
@@ -165,10 +191,11 @@ class Command:
         #       -s | --space [#space:homeserver] - Use this flag if you want to include space name in the room topic
         #       -pu | --preview-url [website_url] - Use this flag if you want to include stickerpack preview url in the room topic
         #       -upd | --update-room - Use this flag if you want to update room avatar, name and topic
+        #       -cs | --contact-sheet - Send one grid image of the pack instead of separate stickers, also used as the room avatar
         #       IF flags are provided, without parameters, then parameters are taken from the pack content if were provided on import or config!
         #       IF boolean flags are true in config, and are provided, they are applied as a False.
 
-        previewer = MatrixPreview(self.client, self.room)
+        previewer = MatrixPreview(self.client, self.room, self.config, self.media_index)
         async for status in previewer.generate_stickerset_preview_to_room(pack_name, flags):
             switch = {
                 MatrixPreview.STATUS_NO_PERMISSION: (
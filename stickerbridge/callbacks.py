@@ -3,21 +3,35 @@ import traceback
 
 from nio import AsyncClient, MatrixRoom, RoomMessageText, InviteMemberEvent
 
+import metrics
 from bot_commands import Command
-from chat_functions import send_text_to_room
+from chat_functions import send_text_to_room, room_state_cache
+from config import Config
+from job_scheduler import JobScheduler
+from media_index import MediaIndex
+from sync_token import SyncTokenStore
 from telegram_exporter import TelegramExporter
 
 
 class Callbacks:
-    def __init__(self, client: AsyncClient, command_prefix: str, config: dict, tg_exporter: TelegramExporter):
+    def __init__(self, client: AsyncClient, command_prefix: str, config: Config, tg_exporter: TelegramExporter,
+                 media_index: MediaIndex = None, scheduler: JobScheduler = None, sync_token: SyncTokenStore = None):
         self.client = client
         self.command_prefix = command_prefix
         self.config = config
         self.tg_exporter = tg_exporter
+        self.media_index = media_index
+        self.scheduler = scheduler
+        self.sync_token = sync_token
 
     async def sync(self, response):
-        with open('data/next_batch', 'w') as next_batch_token:
-            next_batch_token.write(response.next_batch)
+        metrics.sync_succeeded()
+        room_state_cache.update(response)
+        if self.sync_token is not None:
+            self.sync_token.update(response.next_batch)
+
+    async def sync_error(self, response):
+        metrics.MATRIX_ERRORS.inc(operation="sync")
 
     async def message(self, room: MatrixRoom, event: RoomMessageText) -> None:
 
@@ -30,13 +44,29 @@ class Callbacks:
             return
 
         if event.body.startswith(self.command_prefix) or room.member_count <= 2:
+            # a changed config.yaml applies to the commands from now on, a broken one is reported and not used
+            config_error = self.config.reload_if_changed()
+            if config_error:
+                await send_text_to_room(self.client, room.room_id,
+                                        f"Warning: config.yaml could not be reloaded, using the previous config:\n{config_error}")
+
             command_string = event.body.replace(self.command_prefix, '').strip()
-            command = Command(self.client, room, command_string, self.tg_exporter)
-            try:
-                await command.process()
-            except Exception as e:
-                logging.error(traceback.format_exc())
-                await send_text_to_room(self.client, room.room_id, 'Sorry, there was an internal error:\n' + str(e))
+            command = Command(self.client, room, command_string, self.tg_exporter, self.media_index, self.config)
+            if self.scheduler is None or not command.is_long_running():
+                await self._process_command(room, command)
+                return
+
+            # Long commands run in the background, so one import doesn't hold up messages from other rooms
+            position = self.scheduler.submit(room.room_id, lambda: self._process_command(room, command))
+            if position:
+                await send_text_to_room(self.client, room.room_id, f"Your command is queued, position in the queue: {position}")
+
+    async def _process_command(self, room: MatrixRoom, command: Command):
+        try:
+            await command.process()
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            await send_text_to_room(self.client, room.room_id, 'Sorry, there was an internal error:\n' + str(e))
 
     async def autojoin_room(self, room: MatrixRoom, event: InviteMemberEvent):
 
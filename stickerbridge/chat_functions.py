@@ -1,94 +1,211 @@
+import io
 import os
+import time
 from typing import Union
 
 import aiofiles.os
 import magic
 import logging
 
-from nio import AsyncClient, UploadResponse, ErrorResponse, RoomGetStateEventError
+from nio import AsyncClient, UploadResponse, ErrorResponse, RoomGetStateEventError, SyncResponse, MemoryDownloadResponse
 
+import metrics
 from sticker_types import MatrixStickerset
 
 
+def _count_error(response, operation: str):
+    if isinstance(response, ErrorResponse):
+        metrics.MATRIX_ERRORS.inc(operation=operation)
+    return response
+
+
+class RoomStateCache:
+    """State events of the rooms the bot is in, so lookups don't need a request to the homeserver.
+
+    Events fetched once are kept up to date by sync and dropped when we change them ourselves.
+    Sync only updates events that were looked up before, so member events of big rooms don't pile up.
+    The cache is only used once it is fed by sync, without sync (in the cli) every lookup is a request."""
+
+    def __init__(self):
+        self.synced = False
+        self._contents = {}
+        # bumped on every change of a key, so a fetch that raced with sync doesn't store outdated content
+        self._generations = {}
+
+    def get(self, room_id: str, event_type: str, state_key: str = "") -> Union[dict, None]:
+        if not self.synced:
+            return None
+        return self._contents.get((room_id, event_type, state_key), None)
+
+    def generation(self, room_id: str, event_type: str, state_key: str = "") -> int:
+        """Current generation of the key, which from now on is tracked by sync"""
+        return self._generations.setdefault((room_id, event_type, state_key), 0)
+
+    def store(self, room_id: str, event_type: str, state_key: str, content: dict, generation: int):
+        key = (room_id, event_type, state_key)
+        if self.synced and self._generations.get(key, 0) == generation:
+            self._contents[key] = content
+
+    def invalidate(self, room_id: str, event_type: str, state_key: str = ""):
+        key = (room_id, event_type, state_key)
+        self._contents.pop(key, None)
+        self._generations[key] = self._generations.get(key, 0) + 1
+
+    def update(self, response: SyncResponse):
+        for room_id, room_info in response.rooms.join.items():
+            for event in room_info.state + room_info.timeline.events:
+                source = getattr(event, 'source', {})
+                if 'state_key' not in source or 'type' not in source:
+                    continue
+                key = (room_id, source['type'], source['state_key'])
+                if key not in self._generations:
+                    continue
+                self._contents[key] = source.get('content', {})
+                self._generations[key] = self._generations.get(key, 0) + 1
+        for room_id in response.rooms.leave:
+            for key in [key for key in self._contents if key[0] == room_id]:
+                self.invalidate(*key)
+        self.synced = True
+
+
+room_state_cache = RoomStateCache()
+
+
+async def get_state_event(client: AsyncClient, room_id: str, event_type: str, state_key: str = "",
+                          force_refresh: bool = False) -> Union[dict, ErrorResponse]:
+    """Content of a state event, {} when the room doesn't have it. Served from the room state cache
+    unless force_refresh is set, the error response is returned when the homeserver request fails"""
+    if not force_refresh:
+        content = room_state_cache.get(room_id, event_type, state_key)
+        if content is not None:
+            return content
+    generation = room_state_cache.generation(room_id, event_type, state_key)
+    response = await client.room_get_state_event(room_id, event_type, state_key)
+    if isinstance(response, RoomGetStateEventError) and response.status_code == 'M_NOT_FOUND':
+        content = {}
+    elif isinstance(response, ErrorResponse):
+        return _count_error(response, "get_state")
+    else:
+        content = response.content
+    room_state_cache.store(room_id, event_type, state_key, content, generation)
+    return content
+
+
+async def put_state_event(client: AsyncClient, room_id: str, event_type: str, content: dict, state_key: str = "",
+                          only_if_changed: bool = False):
+    """Set a state event, with only_if_changed nothing is sent when the room already has this content"""
+    if only_if_changed and await get_state_event(client, room_id, event_type, state_key) == content:
+        return None
+    response = await client.room_put_state(room_id, event_type, content, state_key=state_key)
+    # the new content arrives with the next sync, until then it's fetched again
+    room_state_cache.invalidate(room_id, event_type, state_key)
+    return _count_error(response, "put_state")
+
+
 async def send_text_to_room(client: AsyncClient, room_id: str, message: str):
     content = {
         "msgtype": "m.notice",
         "body": message,
     }
-    return await client.room_send(
+    return _count_error(await client.room_send(
         room_id,
         "m.room.message",
         content,
-    )
+    ), "send")
 
 async def send_text_to_room_as_text(client: AsyncClient, room_id: str, message: str):
     content = {
         "msgtype": "m.text",
         "body": message,
     }
-    return await client.room_send(
+    return _count_error(await client.room_send(
         room_id,
         "m.room.message",
         content,
-    )
+    ), "send")
 
 async def send_sticker_to_room(client: AsyncClient, room_id: str, content: dict):
-    return await client.room_send(
+    return _count_error(await client.room_send(
         room_id,
         "m.sticker",
         content,
-    )
+    ), "send")
 
-async def has_permission(client: AsyncClient, room_id: str, permission_type: str):
+async def send_image_to_room(client: AsyncClient, room_id: str, mxc_uri: str, filename: str, caption: str, info: dict):
+    content = {
+        "msgtype": "m.image",
+        "body": caption,
+        "filename": filename,
+        "url": mxc_uri,
+        "info": info,
+    }
+    return _count_error(await client.room_send(
+        room_id,
+        "m.room.message",
+        content,
+    ), "send")
+
+async def has_permission(client: AsyncClient, room_id: str, permission_type: str, force_refresh: bool = False):
     """Reimplementation of AsyncClient.has_permission because matrix-nio version always gives an error
     https://github.com/poljar/matrix-nio/issues/324"""
     user_id = client.user
-    power_levels = await client.room_get_state_event(room_id, "m.room.power_levels")
+    power_levels = await get_state_event(client, room_id, "m.room.power_levels", force_refresh=force_refresh)
+    if isinstance(power_levels, ErrorResponse):
+        logging.error(f"Failed to get the power levels of {room_id}. Failure response: {power_levels}")
+        return False
     try:
-        user_power_level = power_levels.content['users'][user_id]
+        user_power_level = power_levels['users'][user_id]
     except KeyError:
         try:
-            user_power_level = power_levels.content['users_default']
+            user_power_level = power_levels['users_default']
         except KeyError:
             return ErrorResponse("Couldn't get user power levels")
 
     try:
-        permission_power_level = power_levels.content[permission_type]
+        permission_power_level = power_levels[permission_type]
     except KeyError:
         return ErrorResponse(f"permission_type {permission_type} unknown")
 
     return user_power_level >= permission_power_level
 
 
-async def is_stickerpack_existing(client: AsyncClient, room_id: str, pack_name: str):
-    response = (await client.room_get_state_event(room_id, 'im.ponies.room_emotes', pack_name))
-    if isinstance(response, RoomGetStateEventError) and response.status_code == 'M_NOT_FOUND':
-        return False
-    return not response.content == {}
+async def is_stickerpack_existing(client: AsyncClient, room_id: str, pack_name: str, force_refresh: bool = False):
+    return not await get_stickerpack(client, room_id, pack_name, force_refresh) == {}
 
 
-async def get_stickerpack(client: AsyncClient, room_id: str, pack_name: str):
-    response = (await client.room_get_state_event(room_id, 'im.ponies.room_emotes', pack_name))
-    return response.content
+async def get_stickerpack(client: AsyncClient, room_id: str, pack_name: str, force_refresh: bool = False):
+    content = await get_state_event(client, room_id, 'im.ponies.room_emotes', pack_name, force_refresh)
+    if isinstance(content, ErrorResponse):
+        raise ValueError(f"Couldn't get the stickerpack {pack_name}: {content}")
+    return content
 
 
 async def upload_stickerpack(client: AsyncClient, room_id: str, stickerset: MatrixStickerset, name):
-    return await client.room_put_state(room_id, 'im.ponies.room_emotes', stickerset.json(), state_key=name)
+    return await put_state_event(client, room_id, 'im.ponies.room_emotes', stickerset.json(), name)
 
 async def update_room_image(client: AsyncClient, room_id: str, image: str):
-    return await client.room_put_state(room_id, 'm.room.avatar', {"url": image})
+    return await put_state_event(client, room_id, 'm.room.avatar', {"url": image}, only_if_changed=True)
 
 async def update_room_name(client: AsyncClient, room_id: str, name: str):
-    return await client.room_put_state(room_id, 'm.room.name', {"name": name})
+    return await put_state_event(client, room_id, 'm.room.name', {"name": name}, only_if_changed=True)
 
 async def update_room_topic(client: AsyncClient, room_id: str, topic: str):
-    return await client.room_put_state(room_id, 'm.room.topic', {"topic": topic})
+    return await put_state_event(client, room_id, 'm.room.topic', {"topic": topic}, only_if_changed=True)
+
+async def download_bytes(client: AsyncClient, mxc_uri: str) -> Union[bytes, None]:
+    response = await client.download(mxc=mxc_uri)
+    if isinstance(response, MemoryDownloadResponse):
+        return response.body
+    logging.warning(f"Failed to download {mxc_uri}: {response}")
+    metrics.MATRIX_ERRORS.inc(operation="download")
+    return None
 
 async def upload_image(client: AsyncClient, image: str, name: Union[str, None] = None):
     mime_type = magic.from_file(image, mime=True)
     file_stat = await aiofiles.os.stat(image)
     if name is None:
         name = os.path.basename(image)
+    started = time.monotonic()
     async with aiofiles.open(image, "r+b") as f:
         try:
             resp, maybe_keys = await client.upload(
@@ -99,12 +216,41 @@ async def upload_image(client: AsyncClient, image: str, name: Union[str, None] =
             )
         except:
             logging.error(f"Failed to upload image ({image})")
+            metrics.MATRIX_ERRORS.inc(operation="upload")
             return ""
     if isinstance(resp, UploadResponse):
         logging.debug(f"Image {image} was uploaded successfully to server.")
+        metrics.UPLOAD_SECONDS.observe(time.monotonic() - started)
+        metrics.UPLOAD_BYTES.inc(file_stat.st_size)
         return resp.content_uri
     else:
         logging.error(f"Failed to upload image ({image}). Failure response: {resp}")
+        metrics.MATRIX_ERRORS.inc(operation="upload")
+        return ""
+
+
+async def upload_bytes(client: AsyncClient, data: bytes, content_type: str, name: str):
+    """Upload in-memory data with a known content type, without touching the filesystem"""
+    started = time.monotonic()
+    try:
+        resp, maybe_keys = await client.upload(
+            io.BytesIO(data),
+            content_type=content_type,
+            filename=name,
+            filesize=len(data),
+        )
+    except:
+        logging.error(f"Failed to upload image ({name})")
+        metrics.MATRIX_ERRORS.inc(operation="upload")
+        return ""
+    if isinstance(resp, UploadResponse):
+        logging.debug(f"Image {name} was uploaded successfully to server.")
+        metrics.UPLOAD_SECONDS.observe(time.monotonic() - started)
+        metrics.UPLOAD_BYTES.inc(len(data))
+        return resp.content_uri
+    else:
+        logging.error(f"Failed to upload image ({name}). Failure response: {resp}")
+        metrics.MATRIX_ERRORS.inc(operation="upload")
         return ""
 
 
@@ -1,13 +1,19 @@
 import argparse
 import asyncio
+import csv
 import os
 import sys
+import time
 import yaml
 import shutil
 import logging
 
 from nio import AsyncClient, RoomVisibility
+from config import Config, ConfigError
 from matrix_reuploader import MatrixReuploader
+from media_index import MediaIndex, rebuild_media_index
+from static_site import build_site
+from sticker_cache import StickerCache
 from telegram_exporter import TelegramExporter
 from matrix_preview import MatrixPreview
 
@@ -41,6 +47,7 @@ import_cmd.add_argument('--room', '-rm', type=str, help='Set a room for the stic
 import_cmd.add_argument('--create-room', '-cr', action='store_true', help='Create a new room for imported stickers')
 import_cmd.add_argument('--space', '-s', type=str, help='Space to include the new room in. (You will need to invite the bot first!)')
 import_cmd.add_argument('--update-pack', '-upd', action='store_true', help='Update pack if it already exists')
+import_cmd.add_argument('--trace', '-t', action='store_true', help='Write timings of every import stage to data/traces')
 
 import_cmd.epilog = 'IF boolean flags are true in "config.yaml" or "cli.yaml", and are provided here, they are applied as a False.'
 
@@ -55,17 +62,37 @@ preview_cmd.add_argument('--space', '-s', type=str, help='Include space name in
 preview_cmd.add_argument('--tg-url', '-tu', type=str, help='Include stickerpack url in the last message', nargs="?", default='False')
 preview_cmd.add_argument('--preview-url', '-pu', type=str, help='Include stickerpack preview url in the room topic', nargs="?", default='False')
 preview_cmd.add_argument('--update-room', '-upd', action='store_true', help='Update room avatar, name and topic')
+preview_cmd.add_argument('--contact-sheet', '-cs', action='store_true', help='Send one grid image of the pack instead of separate stickers, also used as the room avatar')
 
 preview_cmd.epilog = 'IF flags are provided, without parameters, then parameters are taken from the pack content if were provided on import or config!\nIF boolean flags are true in "config.yaml" or "cli.yaml", and are provided here, they are applied as a False.'
 
+import_batch_cmd = subparsers.add_parser('import-batch', help='Import many Telegram stickerpacks listed in a manifest file.')
+import_batch_cmd.add_argument('manifest', type=str, help='YAML or CSV file with one pack per row. Columns: pack, room, import_name, artist, artist_url, rating, primary, json, update_pack, create_room, space, trace')
+import_batch_cmd.add_argument('--parallel', '-P', type=int, help='How many packs are imported at the same time', default=None)
+import_batch_cmd.add_argument('--create-room', '-cr', action='store_true', help='Create rooms for packs which do not have one')
+import_batch_cmd.add_argument('--trace', '-t', action='store_true', help='Write timings of every import stage to data/traces')
+
+reindex_cmd = subparsers.add_parser('reindex', help='Rebuild the index of already uploaded stickers from the stickerpacks in all joined rooms.')
+
+site_cmd = subparsers.add_parser('site', help='Generate a static gallery of the packs imported with --json, only changed packs are rendered again.')
+site_cmd.add_argument('--source', type=str, help='Directory with the maunium json files of the packs', default='data/stickersets')
+site_cmd.add_argument('--output', '-o', type=str, help='Directory of the generated site, pack pages are in <output>/packs/<pack name>/', default='data/site')
+site_cmd.add_argument('--page-size', type=int, help='Packs on one page of the index', default=100)
+site_cmd.add_argument('--media-url', type=str, required=True, help='Url that mxc server names and media ids are appended to. '
+                      'Homeservers with authenticated media, like matrix.org, do not serve new media on the unauthenticated '
+                      '/_matrix/media/v3/download/ url, use a media proxy that serves it without a token there')
+
 async def main(args):
     os.makedirs('data', exist_ok=True)
     if not os.path.exists(args.config):
         shutil.copy('config.yaml.example', args.config)
         logging.warning('Please fill in config.yaml file, to use the cli!')
         return
-    with open(args.config, 'r') as config_file:
-        config = yaml.safe_load(config_file)
+    try:
+        config = Config(args.config)
+    except ConfigError as e:
+        logging.error(e)
+        sys.exit(1)
 
     if not os.path.exists(args.cli_config):
         shutil.copy('cli.yaml.example', args.cli_config)
@@ -75,6 +102,13 @@ async def main(args):
     fmt = f"%(asctime)-20s | %(filename)-20s | %(levelname)s : %(message)s"
     logging.basicConfig(level=os.environ.get("LOGLEVEL", config['log_level']), format=fmt, handlers=[logging.StreamHandler()])
 
+    if sys.argv[1] == 'site':
+        # works on local files only, so there is no need to log in
+        stats = build_site(args.source, args.output, args.media_url, args.page_size)
+        logging.info(f"Site generated in {args.output}: {stats['built']} packs built, {stats['unchanged']} unchanged, "
+                     f"{stats['removed']} removed, {stats['index_files']} index files written")
+        return
+
     client = AsyncClient(config['matrix_homeserver'], config['matrix_username'])
     client.device_id = config['matrix_bot_name']
 
@@ -89,14 +123,22 @@ async def main(args):
         sys.exit(1)
     logging.info("Logged In: " + login_response.user_id)
 
+    media_index = MediaIndex('data/media_index.db')
+
     if sys.argv[1] == 'import':
-        await import_stickerpack(args, client, config, cli_config)
+        await import_stickerpack(args, client, config, cli_config, media_index)
+    if sys.argv[1] == 'import-batch':
+        await import_batch(args, client, config, cli_config, media_index)
     if sys.argv[1] == 'preview':
-        await preview_stickerpack(args, client, config, cli_config)
+        await preview_stickerpack(args, client, config, cli_config, media_index)
+    if sys.argv[1] == 'reindex':
+        indexed = await rebuild_media_index(client, media_index)
+        logging.info(f"Indexed {indexed} stickers, {media_index.count()} unique in total")
 
+    media_index.close()
     await client.close()
 
-async def import_stickerpack(args: argparse.Namespace, client: AsyncClient, config: dict, cli_config: dict):
+async def import_stickerpack(args: argparse.Namespace, client: AsyncClient, config: Config, cli_config: dict, media_index: MediaIndex):
     if args.pack_name.startswith('https://t.me/addstickers/'):
         args.__setattr__("pack_name", args.pack_name.split('/')[-1])
 
@@ -110,6 +152,8 @@ async def import_stickerpack(args: argparse.Namespace, client: AsyncClient, conf
         __exporter_args.append('-j')
     if args.update_pack:
         __exporter_args.append('-upd')
+    if args.trace:
+        __exporter_args.append('-t')
     if args.rating:
         __exporter_args.append('-r')
         __exporter_args.append(args.rating)
@@ -132,17 +176,44 @@ async def import_stickerpack(args: argparse.Namespace, client: AsyncClient, conf
     if not room:
         return
 
-    tg_exporter = TelegramExporter(config['telegram_api_id'], config['telegram_api_hash'], config['telegram_bot_token'],
-                            'data/telegram_secrets')
+    tg_exporter = create_exporter(config)
     await tg_exporter.connect()
 
-    reuploader = MatrixReuploader(client, AttrDict({'room_id': room}), exporter=tg_exporter)
+    await run_import(client, room, tg_exporter, media_index, config, args.pack_name, args.import_name, __exporter_args)
+    await tg_exporter.close()
+
+
+def create_exporter(config: Config) -> TelegramExporter:
+    sticker_cache = None
+    cache_max_size_mb = config['conversion']['cache_max_size_mb']
+    if cache_max_size_mb:
+        sticker_cache = StickerCache('data/sticker_cache', int(cache_max_size_mb * 1024 * 1024))
+    return TelegramExporter(config['telegram_api_id'], config['telegram_api_hash'], config['telegram_bot_token'],
+                            'data/telegram_secrets',
+                            download_concurrency=config['telegram']['download_concurrency'],
+                            conversion_workers=config['conversion']['workers'],
+                            conversion_max_tasks_per_child=config['conversion']['max_tasks_per_child'],
+                            cache=sticker_cache,
+                            stickersets_directory='data/telegram_stickersets',
+                            resample=config['conversion']['resample'],
+                            thumbnail_size=config['conversion']['thumbnail_size'],
+                            frame_chunk_size=config['conversion']['frame_chunk_size'],
+                            time_budget=config['conversion']['time_budget'],
+                            spool_directory=config['conversion']['spool_directory'])
+
+
+async def run_import(client: AsyncClient, room: str, tg_exporter: TelegramExporter, media_index: MediaIndex, config: Config,
+                     pack_name: str, import_name: str, exporter_args: list[str]) -> int:
+    """Import a single pack into the room, returns the last status of the import"""
+    reuploader = MatrixReuploader(client, AttrDict({'room_id': room}), exporter=tg_exporter, media_index=media_index,
+                                  upload_concurrency=config['matrix_upload_concurrency'], config=config)
+    last_status = None
     async for status in reuploader.import_stickerset_to_room(
-            args.pack_name, args.import_name, __exporter_args
+            pack_name, import_name, exporter_args
         ):
             switch = {
-                MatrixReuploader.STATUS_DOWNLOADING: f"Downloading stickerpack {args.pack_name}...",
-                MatrixReuploader.STATUS_UPLOADING: f"Uploading stickerpack {args.pack_name}...",
+                MatrixReuploader.STATUS_DOWNLOADING: f"Downloading stickerpack {pack_name}...",
+                MatrixReuploader.STATUS_UPLOADING: f"Uploading stickerpack {pack_name}...",
                 MatrixReuploader.STATUS_UPDATING_ROOM_STATE: f"Updating room state...",
                 MatrixReuploader.STATUS_OK: "Done",
                 MatrixReuploader.STATUS_NO_PERMISSION: (
@@ -150,22 +221,140 @@ async def import_stickerpack(args: argparse.Namespace, client: AsyncClient, conf
                     "Please, give me mod 🙏"
                 ),
                 MatrixReuploader.STATUS_PACK_EXISTS: (
-                    f"Stickerpack '{args.pack_name}' already exists.\n"
+                    f"Stickerpack '{pack_name}' already exists.\n"
                     "Please delete it first."
                 ),
                 MatrixReuploader.STATUS_PACK_UPDATE: (
-                    f"Updating Stickerpack '{args.pack_name}'.\n"
+                    f"Updating Stickerpack '{pack_name}'.\n"
+                ),
+                MatrixReuploader.STATUS_PACK_UNCHANGED: (
+                    f"Stickerpack '{pack_name}' is already up to date."
+                ),
+                MatrixReuploader.STATUS_CONVERSION_FALLBACK: (
+                    f"Warning: some animated stickers of '{pack_name}' took too long to convert and were imported as a static image.\n"
+                    "Update the pack later to convert them again."
+                ),
+                MatrixReuploader.STATUS_STICKERS_SKIPPED: (
+                    f"Warning: some stickers of '{pack_name}' failed to download, convert or upload and were left out.\n"
+                    "Update the pack later to import them again."
                 ),
                 MatrixReuploader.STATUS_PACK_EMPTY: (
-                    f"Warning: Telegram pack {args.pack_name} find out empty or not existing."
+                    f"Warning: Telegram pack {pack_name} find out empty or not existing."
                 ),
             }
             text = switch.get(status, "Warning: Unknown status")
             logging.info(text)
-    await tg_exporter.close()
+            last_status = status
+    return last_status
+
+
+def _read_manifest(filename: str) -> list[dict]:
+    with open(filename, 'r', encoding='utf-8') as manifest_file:
+        if filename.endswith('.csv'):
+            return [{key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()}
+                    for row in csv.DictReader(manifest_file)]
+        rows = yaml.safe_load(manifest_file) or []
+    if isinstance(rows, dict):
+        rows = rows.get('packs', None) or []
+    if not isinstance(rows, list):
+        logging.error(f'Manifest "{filename}" must be a list of packs')
+        return []
+    checked = []
+    for number, row in enumerate(rows, 1):
+        # a row is a mapping of columns, or just the pack
+        if isinstance(row, (str, int)) and not isinstance(row, bool):
+            row = {'pack': str(row)}
+        if not isinstance(row, dict):
+            logging.error(f'Skipping row {number} of manifest "{filename}", it must be a pack or a mapping of columns: {row!r}')
+            continue
+        checked.append(row)
+    return checked
+
+
+def _manifest_flag(row: dict, key: str, default: bool) -> bool:
+    value = row.get(key, default)
+    if isinstance(value, str):
+        return value.lower() in ['1', 'true', 'yes', 'y']
+    return bool(value)
+
+
+async def import_batch(args: argparse.Namespace, client: AsyncClient, config: Config, cli_config: dict, media_index: MediaIndex):
+    rows = _read_manifest(args.manifest)
+    if not rows:
+        logging.error(f'Manifest "{args.manifest}" has no packs')
+        return
+
+    status_names = {value: name for name, value in vars(MatrixReuploader).items() if name.startswith('STATUS_')}
+
+    tg_exporter = create_exporter(config)
+    await tg_exporter.connect()
+
+    semaphore = asyncio.Semaphore(max(1, args.parallel or cli_config['import'].get('batch_parallel', 2)))
+    # Rows of the same room run one after another, like the jobs of a room in the bot
+    room_locks = {}
+
+    def _room_key(row: dict, pack_name: str) -> str:
+        room = str(row.get('room', None) or f"{cli_config['room']['prefix']}{pack_name}")
+        if not room.startswith(('#', '!')):
+            room = f"#{room}:{cli_config['room']['homeserver']}"
+        return room
+
+    async def _import_row(row: dict):
+        pack_name = ''
+        try:
+            pack_name = str(row.get('pack', None) or '').split('/')[-1]
+            if not pack_name:
+                return pack_name, 'NO_PACK', 0.0
+            room_lock = room_locks.setdefault(_room_key(row, pack_name), asyncio.Lock())
+        except Exception as e:
+            logging.error(f"Failed to import {pack_name}: {e}")
+            return pack_name, 'ERROR', 0.0
+
+        async with room_lock, semaphore:
+            started = time.monotonic()
+            try:
+                room_args = argparse.Namespace(
+                    pack_name=pack_name,
+                    room=row.get('room', None),
+                    create_room=_manifest_flag(row, 'create_room', args.create_room),
+                    space=row.get('space', None),
+                )
+                exporter_args = []
+                # Manifest values are absolute, the flags toggle the config defaults, so they are only passed on a difference
+                for key, flag in [('primary', '-p'), ('json', '-j'), ('update_pack', '-upd')]:
+                    default = bool(config['import'][key])
+                    if _manifest_flag(row, key, default) != default:
+                        exporter_args.append(flag)
+                if _manifest_flag(row, 'trace', args.trace):
+                    exporter_args.append('-t')
+                for key, flag in [('rating', '-r'), ('artist', '-a'), ('artist_url', '-au')]:
+                    if row.get(key, None):
+                        exporter_args.extend([flag, str(row[key])])
+
+                room = await create_or_get_room(room_args, client, config, cli_config)
+                if not room:
+                    result = 'NO_ROOM'
+                else:
+                    status = await run_import(client, room, tg_exporter, media_index, config, pack_name,
+                                              str(row.get('import_name', pack_name)), exporter_args)
+                    result = status_names.get(status, 'UNKNOWN').replace('STATUS_', '')
+            except Exception as e:
+                logging.error(f"Failed to import {pack_name}: {e}")
+                result = 'ERROR'
+            return pack_name, result, time.monotonic() - started
+
+    batch_started = time.monotonic()
+    try:
+        results = await asyncio.gather(*[_import_row(row) for row in rows])
+    finally:
+        await tg_exporter.close()
+
+    logging.info(f"Imported {len(results)} packs in {time.monotonic() - batch_started:.1f}s")
+    for pack_name, result, duration in results:
+        logging.info(f"{pack_name:<40} {result:<20} {duration:8.1f}s")
 
 
-async def create_or_get_room(args: argparse.Namespace, client: AsyncClient, config: dict, cli_config: dict):
+async def create_or_get_room(args: argparse.Namespace, client: AsyncClient, config: Config, cli_config: dict):
 
     if not cli_config['room']['homeserver']:
         logging.error('Please set room homeserver in cli.yaml')
@@ -296,7 +485,8 @@ async def create_or_get_room(args: argparse.Namespace, client: AsyncClient, conf
     return room.room_id
 
 
-async def preview_stickerpack(args: argparse.Namespace, client: AsyncClient, config: dict, cli_config: dict):
+async def preview_stickerpack(args: argparse.Namespace, client: AsyncClient, config: Config, cli_config: dict,
+                              media_index: MediaIndex = None):
 
     if args.pack_name == "" and args.room == "":
         logging.error('At least one of "pack-name" or "room" must be set')
@@ -308,6 +498,8 @@ async def preview_stickerpack(args: argparse.Namespace, client: AsyncClient, con
         __pack_name = ""
     if args.update_room:
         __preview_args.append('-upd')
+    if args.contact_sheet:
+        __preview_args.append('-cs')
     if args.artist != 'False' or cli_config['preview']['include_artist']:
         __preview_args.append('-a')
         if args.artist is not None and args.artist != 'False':
@@ -333,7 +525,7 @@ async def preview_stickerpack(args: argparse.Namespace, client: AsyncClient, con
     if not room:
         return False
 
-    previewer = MatrixPreview(client, AttrDict({'room_id': room}))
+    previewer = MatrixPreview(client, AttrDict({'room_id': room}), config, media_index)
     async for status in previewer.generate_stickerset_preview_to_room(__pack_name, __preview_args):
         switch = {
             MatrixPreview.STATUS_NO_PERMISSION: (
@@ -350,7 +542,7 @@ async def preview_stickerpack(args: argparse.Namespace, client: AsyncClient, con
         logging.info(text)
 
 
-async def get_room(args: argparse.Namespace, client: AsyncClient, config: dict, cli_config: dict):
+async def get_room(args: argparse.Namespace, client: AsyncClient, config: Config, cli_config: dict):
     room_alias = f'{cli_config['room']['prefix']}{args.pack_name}'
     if args.room != "":
         room_alias = args.room
@@ -0,0 +1,176 @@
+import copy
+import logging
+import os
+from collections.abc import Mapping
+from typing import Union
+
+import yaml
+
+# Every optional setting with its default, a setting missing from config.yaml gets the value from here.
+# A setting with a default other than None must have the same type as its default.
+DEFAULTS = {
+    "telegram": {
+        "download_concurrency": 4,
+    },
+    "conversion": {
+        "workers": None,
+        "max_tasks_per_child": 100,
+        "cache_max_size_mb": 512.0,
+        "resample": "lanczos",
+        "thumbnail_size": 0,
+        "time_budget": 120.0,
+        "frame_chunk_size": 0,
+        "spool_directory": None,
+    },
+    "matrix_upload_concurrency": 4,
+    "max_concurrent_jobs": 2,
+    "sync_token_save_interval": 5.0,
+    "metrics": {
+        "host": "127.0.0.1",
+        "port": 0,
+    },
+    "import": {
+        "primary": True,
+        "json": True,
+        "update_pack": True,
+        "json_gzip": False,
+    },
+    "preview": {
+        "space": None,
+        "preview_url_base": None,
+        "update_room": True,
+        "contact_sheet": False,
+        "contact_sheet_stickers": 16,
+        "contact_sheet_columns": 4,
+        "contact_sheet_cell_size": 128,
+    },
+    "log_level": "INFO",
+}
+
+REQUIRED = {
+    "telegram_api_id": int,
+    "telegram_api_hash": str,
+    "telegram_bot_token": str,
+    "matrix_homeserver": str,
+    "matrix_username": str,
+    "matrix_login_type": str,
+    "matrix_bot_name": str,
+    "command_prefix": str,
+}
+
+LOGIN_REQUIRED = {
+    "password": {"matrix_password": str},
+    "access_token": {"matrix_token": str, "matrix_deviceid": str},
+}
+
+RESAMPLE_FILTERS = ["nearest", "box", "bilinear", "hamming", "bicubic", "lanczos"]
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def _check_type(name: str, value, expected: type):
+    # ints are fine where a float is expected, but booleans are not numbers here
+    accepted = (int, float) if expected is float else expected
+    if not isinstance(value, accepted) or (isinstance(value, bool) and expected is not bool):
+        raise ConfigError(f'"{name}" must be a {expected.__name__}, not {value!r}')
+
+
+def _merge_defaults(values: dict, defaults: dict, prefix: str = "") -> dict:
+    merged = dict(values)
+    for key, default in defaults.items():
+        name = prefix + key
+        value = values.get(key, None)
+        if isinstance(default, dict):
+            if value is None:
+                value = {}
+            _check_type(name, value, dict)
+            merged[key] = _merge_defaults(value, default, name + ".")
+        elif value is None:
+            merged[key] = copy.copy(default)
+        elif default is not None:
+            _check_type(name, value, type(default))
+    return merged
+
+
+def validate(values: dict) -> dict:
+    """Config with the defaults filled in, raises ConfigError describing the first problem found"""
+    if not isinstance(values, dict):
+        raise ConfigError("the config must be a mapping of settings")
+    for name, expected in REQUIRED.items():
+        if values.get(name, None) is None:
+            raise ConfigError(f'"{name}" is missing')
+        _check_type(name, values[name], expected)
+
+    login_type = values["matrix_login_type"]
+    if login_type not in LOGIN_REQUIRED:
+        raise ConfigError(f'Unknown login type: "{login_type}" only "password" and "access_token" are supported')
+    for name, expected in LOGIN_REQUIRED[login_type].items():
+        if values.get(name, None) is None:
+            raise ConfigError(f'"{name}" is missing, it is needed for the "{login_type}" login type')
+        _check_type(name, values[name], expected)
+
+    config = _merge_defaults(values, DEFAULTS)
+    if config["conversion"]["resample"] not in RESAMPLE_FILTERS:
+        raise ConfigError(f'"conversion.resample" must be one of {", ".join(RESAMPLE_FILTERS)}')
+    for name in ["workers", "max_tasks_per_child"]:
+        if config["conversion"][name] is not None:
+            _check_type(f"conversion.{name}", config["conversion"][name], int)
+    for name in ["contact_sheet_stickers", "contact_sheet_columns", "contact_sheet_cell_size"]:
+        if config["preview"][name] < 1:
+            raise ConfigError(f'"preview.{name}" must be at least 1')
+    return config
+
+
+def load_config(filename: str) -> dict:
+    try:
+        with open(filename, 'r') as config_file:
+            values = yaml.safe_load(config_file)
+    except yaml.YAMLError as e:
+        raise ConfigError(f"{filename} is not valid YAML: {e}")
+    try:
+        return validate(values)
+    except ConfigError as e:
+        raise ConfigError(f"{filename}: {e}")
+
+
+class Config(Mapping):
+    """Validated config.yaml with the defaults filled in, loaded once and shared by all commands.
+
+    reload_if_changed() loads the file again only when its modification time changed. A bad edit is reported
+    and the previous config stays in use. Settings used at startup, like the conversion pool, need a restart."""
+
+    def __init__(self, filename: str = 'config.yaml'):
+        self.filename = filename
+        self._mtime = os.stat(filename).st_mtime_ns
+        self._values = load_config(filename)
+        self.error = None
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def reload_if_changed(self) -> Union[str, None]:
+        """Returns the error when the changed file could not be loaded, None otherwise"""
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return None
+        if mtime == self._mtime:
+            return None
+        self._mtime = mtime
+        try:
+            self._values = load_config(self.filename)
+        except (ConfigError, OSError) as e:
+            self.error = str(e)
+            logging.error(f"Keeping the previous config, {self.error}")
+            return self.error
+        self.error = None
+        logging.info(f"Reloaded {self.filename}")
+        return None
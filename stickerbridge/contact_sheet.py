@@ -0,0 +1,41 @@
+import hashlib
+import math
+from io import BytesIO
+
+from PIL import Image
+
+
+def contact_sheet_key(urls: list[str], columns: int, cell_size: int) -> str:
+    """Media index key of the contact sheet of these stickers, it changes whenever a sticker on the sheet changes"""
+    content = "\n".join([f"{columns}:{cell_size}"] + urls)
+    return "contact-sheet:" + hashlib.sha256(content.encode()).hexdigest()
+
+
+def contact_sheet_size(count: int, columns: int, cell_size: int) -> tuple[int, int]:
+    columns = max(1, min(columns, count))
+    return columns * cell_size, math.ceil(count / columns) * cell_size
+
+
+def render_contact_sheet(images: list[bytes], columns: int, cell_size: int) -> bytes:
+    """PNG grid of the images, every image is scaled to fit its cell and animations show their first frame.
+    Images that can't be decoded leave their cell empty."""
+    width, height = contact_sheet_size(len(images), columns, cell_size)
+    columns = width // cell_size
+    sheet = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    for index, data in enumerate(images):
+        if data is None:
+            continue
+        try:
+            with Image.open(BytesIO(data)) as image:
+                image.seek(0)
+                tile = image.convert("RGBA")
+        except Exception:
+            continue
+        tile.thumbnail((cell_size, cell_size), Image.LANCZOS)
+        x = (index % columns) * cell_size + (cell_size - tile.width) // 2
+        y = (index // columns) * cell_size + (cell_size - tile.height) // 2
+        sheet.alpha_composite(tile, (x, y))
+
+    output = BytesIO()
+    sheet.save(output, "PNG", optimize=True)
+    return output.getvalue()
@@ -0,0 +1,23 @@
+import os
+import tempfile
+from typing import Union
+
+
+def atomic_write(filename: str, content: Union[str, bytes]):
+    """Write the file so readers, and a restart after a crash, see either the old or the new content, never a part.
+
+    The content goes to a temporary file in the same directory, which then replaces the file."""
+    directory = os.path.dirname(filename) or '.'
+    fd, temporary = tempfile.mkstemp(prefix=os.path.basename(filename) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content.encode('utf-8') if isinstance(content, str) else content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, filename)
+    except BaseException:
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,70 @@
+import datetime
+import json
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Union
+
+
+class ImportTrace:
+    """Timings of a single stickerpack import, for finding out where a slow import spends its time.
+
+    Spans of the whole import and of every sticker are collected with their duration, offset from the start
+    of the import and any attributes, like byte sizes or the conversion path, then written as a json report."""
+
+    def __init__(self, pack_name: str):
+        self.pack_name = pack_name
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self._origin = time.monotonic()
+        self.attributes = {}
+        self.spans = []
+        self.stickers = {}
+
+    def sticker(self, document_id: int, **attributes) -> dict:
+        record = self.stickers.setdefault(str(document_id), {"document_id": str(document_id), "spans": []})
+        record.update(attributes)
+        return record
+
+    @contextmanager
+    def span(self, name: str, document_id: int = None, **attributes):
+        """Time the block, the yielded dict can be filled with attributes of the span"""
+        record = {"name": name, "start": round(time.monotonic() - self._origin, 6), **attributes}
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["duration"] = round(time.monotonic() - self._origin - record["start"], 6)
+            if document_id is None:
+                self.spans.append(record)
+            else:
+                self.sticker(document_id)["spans"].append(record)
+
+    def json(self) -> dict:
+        return {
+            "pack_name": self.pack_name,
+            "started": self.started.isoformat(),
+            "duration": round(time.monotonic() - self._origin, 6),
+            **self.attributes,
+            "spans": self.spans,
+            "stickers": list(self.stickers.values()),
+        }
+
+    def write(self, directory: str) -> str:
+        os.makedirs(directory, exist_ok=True)
+        name = re.sub(r'[^\w-]', '_', self.pack_name) or 'primary'
+        filename = os.path.join(directory, f"{name}-{self.started.strftime('%Y%m%dT%H%M%S')}.json")
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(self.json(), f, indent=2)
+        logging.info(f"Import trace of {self.pack_name} written to {filename}")
+        return filename
+
+
+def span(trace: Union[ImportTrace, None], name: str, document_id: int = None, **attributes):
+    """Span of the trace, or a no-op when the import is not traced"""
+    if trace is None:
+        return nullcontext({})
+    return trace.span(name, document_id, **attributes)
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import traceback
+from typing import Awaitable, Callable
+
+
+class JobScheduler:
+    """Runs long commands in the background, so they do not block handling of other messages.
+
+    At most max_concurrent jobs run at the same time, and jobs for the same room run one after another,
+    so two imports never race on the same room state. Waiting jobs are kept in one queue in submission order,
+    a free slot goes to the first of them whose room is not busy."""
+
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max(1, max_concurrent or 1)
+        self._queue: list[tuple[str, Callable[[], Awaitable]]] = []
+        self._busy_rooms: set[str] = set()
+        self._tasks = set()
+
+    def submit(self, room_id: str, job: Callable[[], Awaitable]) -> int:
+        """Queue a job, returns its position in the queue or 0 if it starts right away"""
+        entry = (room_id, job)
+        self._queue.append(entry)
+        self._start_jobs()
+        # the job can only be overtaken by jobs of other rooms, so this is the most it waits for
+        return self._queue.index(entry) + 1 if entry in self._queue else 0
+
+    def _start_jobs(self):
+        while len(self._busy_rooms) < self.max_concurrent:
+            entry = next((entry for entry in self._queue if entry[0] not in self._busy_rooms), None)
+            if entry is None:
+                return
+            self._queue.remove(entry)
+            room_id, job = entry
+            self._busy_rooms.add(room_id)
+            task = asyncio.ensure_future(self._run(room_id, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, room_id: str, job: Callable[[], Awaitable]):
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.error(traceback.format_exc())
+        finally:
+            self._busy_rooms.discard(room_id)
+            self._start_jobs()
+
+    def pending(self) -> int:
+        return len(self._queue)
+
+    async def close(self):
+        self._queue.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
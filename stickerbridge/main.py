@@ -3,13 +3,18 @@ import os
 import shutil
 import tempfile
 
-import yaml
 import logging
 
-from nio import AsyncClient, SyncResponse, RoomMessageText, InviteEvent, InviteMemberEvent
+from nio import AsyncClient, SyncResponse, SyncError, RoomMessageText, InviteEvent, InviteMemberEvent
 
 from callbacks import Callbacks
 from chat_functions import upload_avatar
+from config import Config, ConfigError
+from job_scheduler import JobScheduler
+from media_index import MediaIndex
+from metrics import MetricsServer
+from sticker_cache import StickerCache
+from sync_token import SyncTokenStore
 from telegram_exporter import TelegramExporter
 
 
@@ -19,20 +24,44 @@ async def main():
         shutil.copy('config.yaml.example', 'config.yaml')
         logging.warning('Please fill in config.yaml file, then restart the bot')
         return
-    with open("config.yaml", 'r') as config_file:
-        config = yaml.safe_load(config_file)
+    try:
+        config = Config('config.yaml')
+    except ConfigError as e:
+        logging.error(e)
+        return
 
     logging.basicConfig(level=os.environ.get("LOGLEVEL", config['log_level']))
 
     client = AsyncClient(config['matrix_homeserver'], config['matrix_username'])
     client.device_id = config['matrix_bot_name']
 
+    sticker_cache = None
+    cache_max_size_mb = config['conversion']['cache_max_size_mb']
+    if cache_max_size_mb:
+        sticker_cache = StickerCache('data/sticker_cache', int(cache_max_size_mb * 1024 * 1024))
     tg_exporter = TelegramExporter(config['telegram_api_id'], config['telegram_api_hash'], config['telegram_bot_token'],
-                                   'data/telegram_secrets')
+                                   'data/telegram_secrets',
+                                   download_concurrency=config['telegram']['download_concurrency'],
+                                   conversion_workers=config['conversion']['workers'],
+                                   conversion_max_tasks_per_child=config['conversion']['max_tasks_per_child'],
+                                   cache=sticker_cache,
+                                   stickersets_directory='data/telegram_stickersets',
+                                   resample=config['conversion']['resample'],
+                                   thumbnail_size=config['conversion']['thumbnail_size'],
+                                   frame_chunk_size=config['conversion']['frame_chunk_size'],
+                                   time_budget=config['conversion']['time_budget'],
+                                   spool_directory=config['conversion']['spool_directory'])
     await tg_exporter.connect()
 
-    callbacks = Callbacks(client, config['command_prefix'], config, tg_exporter)
+    media_index = MediaIndex('data/media_index.db')
+
+    scheduler = JobScheduler(config['max_concurrent_jobs'])
+
+    sync_token = SyncTokenStore('data/next_batch', config['sync_token_save_interval'])
+
+    callbacks = Callbacks(client, config['command_prefix'], config, tg_exporter, media_index, scheduler, sync_token)
     client.add_response_callback(callbacks.sync, SyncResponse)
+    client.add_response_callback(callbacks.sync_error, SyncError)
     client.add_event_callback(callbacks.message, RoomMessageText)
     client.add_event_callback(callbacks.autojoin_room, InviteMemberEvent)
 
@@ -45,14 +74,28 @@ async def main():
 
     logging.info(login_response)
 
-    if os.path.exists('data/next_batch'):
-        with open("data/next_batch", "r") as next_batch_token:
-            client.next_batch = next_batch_token.read()
+    next_batch = sync_token.load()
+    if next_batch is not None:
+        client.next_batch = next_batch
     else:
         await upload_avatar(client, 'avatar.png')
         await client.set_displayname(config['matrix_bot_name'])
 
-    await client.sync_forever(30000)
+    metrics_server = None
+    if config['metrics']['port']:
+        metrics_server = MetricsServer(config['metrics']['host'], config['metrics']['port'])
+        await metrics_server.start()
+
+    try:
+        await client.sync_forever(30000)
+    finally:
+        if metrics_server is not None:
+            await metrics_server.close()
+        await sync_token.close()
+        await scheduler.close()
+        await tg_exporter.close()
+        media_index.close()
+        await client.close()
 
 
 if __name__ == '__main__':
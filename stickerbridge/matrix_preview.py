@@ -1,14 +1,16 @@
-from nio import MatrixRoom, AsyncClient
-import yaml
-import os
+import asyncio
+import logging
+from collections.abc import Mapping
+from typing import Union
 
-from chat_functions import has_permission, is_stickerpack_existing, get_stickerpack, send_sticker_to_room, update_room_image, update_room_name, update_room_topic, send_text_to_room_as_text
+from nio import MatrixRoom, AsyncClient
 
-async def _parse_args(args: list, stickerpack) -> dict[str, str]:
+from config import DEFAULTS
+from chat_functions import has_permission, is_stickerpack_existing, get_stickerpack, send_sticker_to_room, update_room_image, update_room_name, update_room_topic, send_text_to_room_as_text, send_image_to_room, download_bytes, upload_bytes
+from contact_sheet import contact_sheet_key, contact_sheet_size, render_contact_sheet
+from media_index import MediaIndex
 
-    if os.path.exists('config.yaml'):
-        with open("config.yaml", 'r') as config_file:
-            config_params = yaml.safe_load(config_file)
+async def _parse_args(args: list, stickerpack, config_params: Mapping) -> dict[str, str]:
 
     parsed_args = {
         "space": config_params['preview']['space'] or None,
@@ -16,7 +18,8 @@ async def _parse_args(args: list, stickerpack) -> dict[str, str]:
         "artist_url": None,
         "tg_url": None,
         "preview_url": config_params['preview']['preview_url_base'] or None,
-        "update_room": config_params['preview']['update_room'] or False
+        "update_room": config_params['preview']['update_room'] or False,
+        "contact_sheet": config_params['preview']['contact_sheet'] or False
     }
 
     if len(args) == 0:
@@ -71,6 +74,8 @@ async def _parse_args(args: list, stickerpack) -> dict[str, str]:
 
         if arg in ["-upd", "--update-room"]:
             parsed_args["update_room"] = not config_params['preview']['update_room']
+        if arg in ["-cs", "--contact-sheet"]:
+            parsed_args["contact_sheet"] = not config_params['preview']['contact_sheet']
 
     return parsed_args, config_params
 
@@ -84,14 +89,49 @@ class MatrixPreview:
 
     STATUS_UPDATING_ROOM_STATE = 3
 
-    def __init__(self, client: AsyncClient, room: MatrixRoom):
+    def __init__(self, client: AsyncClient, room: MatrixRoom, config: Mapping = None, media_index: MediaIndex = None):
 
         self.client = client
         self.room = room
+        self.config = config if config is not None else DEFAULTS
+        self.media_index = media_index
 
     async def _has_permission_to_update(self) -> bool:
         return await has_permission(self.client, self.room.room_id, 'state_default')
 
+    async def _contact_sheet(self, pack_name: str, images: list[dict]) -> Union[tuple[str, dict], None]:
+        """Upload a grid of the first stickers of the pack, returns its mxc uri and image info.
+        The sheet is rendered and uploaded only once for the same stickers, then its mxc uri comes from the media index."""
+        images = images[:max(1, self.config['preview']['contact_sheet_stickers'])]
+        columns = self.config['preview']['contact_sheet_columns']
+        cell_size = self.config['preview']['contact_sheet_cell_size']
+        width, height = contact_sheet_size(len(images), columns, cell_size)
+        info = {"w": width, "h": height, "mimetype": "image/png"}
+
+        key = contact_sheet_key([image['url'] for image in images], columns, cell_size)
+        mxc_uri = self.media_index.get(key) if self.media_index is not None else None
+        if mxc_uri:
+            return mxc_uri, info
+
+        semaphore = asyncio.Semaphore(4)
+
+        async def _download(url: str):
+            async with semaphore:
+                return await download_bytes(self.client, url)
+
+        downloaded = await asyncio.gather(*[_download(image['url']) for image in images])
+        if all(data is None for data in downloaded):
+            return None
+        data = await asyncio.to_thread(render_contact_sheet, downloaded, columns, cell_size)
+        info["size"] = len(data)
+        mxc_uri = await upload_bytes(self.client, data, "image/png", f"{pack_name or 'primary'}__contact_sheet.png")
+        if not mxc_uri:
+            return None
+        # a sheet with cells missing from a failed download is used this time, but rendered again the next time
+        if self.media_index is not None and all(data is not None for data in downloaded):
+            self.media_index.add(key, mxc_uri)
+        return mxc_uri, info
+
     async def generate_stickerset_preview_to_room(self, pack_name: str, flags: list):
         if not await self._has_permission_to_update():
             yield self.STATUS_NO_PERMISSION
@@ -102,7 +142,7 @@ class MatrixPreview:
             return
 
         stickerpack = await get_stickerpack(self.client, self.room.room_id, pack_name)
-        parsed_args, config_params = await _parse_args(flags, stickerpack)
+        parsed_args, config_params = await _parse_args(flags, stickerpack, self.config)
 
         yield self.STATUS_UPDATING_ROOM_STATE
 
@@ -139,11 +179,24 @@ class MatrixPreview:
         topic = " | ".join(topic)
         message = "\n".join(message)
 
+        contact_sheet = None
+        if parsed_args["contact_sheet"]:
+            contact_sheet = await self._contact_sheet(pack_name, list(stickerpack["images"].values()))
+            if contact_sheet is None:
+                logging.warning(f"Failed to make a contact sheet of {pack_name}, sending its stickers instead")
+
         if parsed_args["update_room"]:
-            await update_room_image(self.client, self.room.room_id, _first_item[1]['url'])
+            avatar = contact_sheet[0] if contact_sheet is not None else _first_item[1]['url']
+            await update_room_image(self.client, self.room.room_id, avatar)
             await update_room_name(self.client, self.room.room_id, stickerpack["pack"]["display_name"])
             await update_room_topic(self.client, self.room.room_id, topic)
 
+        if contact_sheet is not None:
+            # One image with the message as its caption
+            mxc_uri, info = contact_sheet
+            await send_image_to_room(self.client, self.room.room_id, mxc_uri, "contact_sheet.png", message, info)
+            return
+
         # Sending stickers. min: 1, maximum: 5
         for stick in list(stickerpack["images"].items())[:5]:
             await send_sticker_to_room(self.client, self.room.room_id, {"body": stick[0], "url": stick[1]['url'], "info": {"mimetype":"image/png"}})
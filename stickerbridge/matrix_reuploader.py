@@ -1,30 +1,32 @@
-import tempfile
+import asyncio
 import os
-import json
-import yaml
 import hashlib
 import logging
 from tqdm.auto import tqdm
 
+from collections.abc import Mapping
+
 from nio import MatrixRoom, AsyncClient
 
-from chat_functions import has_permission, is_stickerpack_existing, get_stickerpack, upload_image, upload_stickerpack
+import metrics
+from config import DEFAULTS
+from import_trace import ImportTrace, span
+from chat_functions import has_permission, is_stickerpack_existing, get_stickerpack, upload_bytes, upload_stickerpack
+from media_index import MediaIndex
 from sticker_types import Sticker, MatrixStickerset, MauniumStickerset
-from telegram_exporter import TelegramExporter
-
-async def _parse_args(args: list) -> dict[str, str]:
+from stickerpicker import save_stickerpack
+from telegram_exporter import TelegramExporter, document_alt_text
 
-    if os.path.exists('config.yaml'):
-        with open("config.yaml", 'r') as config_file:
-            config_params = yaml.safe_load(config_file)
+async def _parse_args(args: list, config: Mapping) -> dict[str, str]:
 
     parsed_args = {
-        "default": config_params['import']['primary'] or False,
-        "json": config_params['import']['json'] or False,
+        "default": config['import']['primary'] or False,
+        "json": config['import']['json'] or False,
         "artist" : None,
         "artist_url" : None,
         "rating" : None,
-        "update_pack": config_params['import']['update_pack'] or False
+        "update_pack": config['import']['update_pack'] or False,
+        "trace": False
     }
 
     if len(args) == 0:
@@ -59,6 +61,8 @@ async def _parse_args(args: list) -> dict[str, str]:
                 if not value.startswith("http"):
                     continue
                 parsed_args["artist_url"] = value
+        if arg in ["-t", "--trace"]:
+            parsed_args["trace"] = True
         if arg in ["-p", "--primary", "-j", "--json", "-upd", "--update-pack"]:
             if arg in ["-p", "--primary"]:
                 parsed_args["default"] = not parsed_args["default"]
@@ -81,9 +85,13 @@ class MatrixReuploader:
     STATUS_UPLOADING = 5
     STATUS_UPDATING_ROOM_STATE = 6
     STATUS_PACK_UPDATE = 7
+    STATUS_PACK_UNCHANGED = 8
+    STATUS_CONVERSION_FALLBACK = 9
+    STATUS_STICKERS_SKIPPED = 10
 
     def __init__(self, client: AsyncClient, room: MatrixRoom, exporter: TelegramExporter = None,
-                 pack: list[Sticker] = None):
+                 pack: list[Sticker] = None, media_index: MediaIndex = None, upload_concurrency: int = 4,
+                 config: Mapping = None):
 
         if not exporter and not pack:
             raise ValueError('Either exporter or the pack must be set')
@@ -92,80 +100,223 @@ class MatrixReuploader:
         self.room = room
         self.exporter = exporter
         self.pack = pack
+        self.media_index = media_index
+        self.upload_concurrency = max(1, upload_concurrency or 1)
+        self.config = config if config is not None else DEFAULTS
+        self.trace = None
 
     async def _has_permission_to_upload(self) -> bool:
         return await has_permission(self.client, self.room.room_id, 'state_default')
 
     async def import_stickerset_to_room(self, pack_name: str, import_name: str, args: list[str]):
+        status_names = {value: name[len('STATUS_'):] for name, value in vars(MatrixReuploader).items()
+                        if name.startswith('STATUS_')}
+        metrics.IMPORTS_IN_PROGRESS.inc()
+        last_status = "ERROR"
+        try:
+            async for status in self._import_stickerset_to_room(pack_name, import_name, args):
+                last_status = status_names.get(status, status)
+                metrics.IMPORTS.inc(status=last_status)
+                yield status
+        except Exception:
+            last_status = "ERROR"
+            metrics.IMPORTS.inc(status="ERROR")
+            raise
+        finally:
+            metrics.IMPORTS_IN_PROGRESS.dec()
+            if self.trace is not None:
+                self.trace.attributes["status"] = last_status
+                try:
+                    self.trace.write(f"{os.getcwd()}/data/traces")
+                except OSError as e:
+                    logging.warning(f"Failed to write import trace of {pack_name}: {e}")
+
+    async def _import_stickerset_to_room(self, pack_name: str, import_name: str, args: list[str]):
         if not await self._has_permission_to_upload():
             yield self.STATUS_NO_PERMISSION
             return
 
-        parsed_args = await _parse_args(args)
+        parsed_args = await _parse_args(args, self.config)
+        trace = self.trace = ImportTrace(pack_name) if parsed_args["trace"] else None
 
         pack_location = pack_name
         if parsed_args["default"]:
             pack_location = ""
 
-        exists = await is_stickerpack_existing(self.client, self.room.room_id, pack_location)
+        with span(trace, "existing_pack"):
+            exists = await is_stickerpack_existing(self.client, self.room.room_id, pack_location)
         stickerpack = None;
         if exists:
             if parsed_args["update_pack"]:
-                stickerpack = await get_stickerpack(self.client, self.room.room_id, pack_location)
+                with span(trace, "existing_pack"):
+                    stickerpack = await get_stickerpack(self.client, self.room.room_id, pack_location)
                 if parsed_args["rating"] is None:
                     parsed_args["rating"] = stickerpack["pack"].get("rating", None)
-                if parsed_args["artist"] is None and stickerpack["pack"].get("artist", None) is not None:
-                    parsed_args["artist"] = stickerpack["pack"]["artist"].get("name", None)
-                if parsed_args["artist_url"] is None and stickerpack["pack"].get("url", None) is not None:
-                    parsed_args["artist_url"] = stickerpack["pack"]["artist"].get("url", None)
+                # the artist is kept in the author of the pack
+                author = stickerpack["pack"].get("author", None)
+                if not isinstance(author, dict):
+                    author = {}
+                if parsed_args["artist"] is None:
+                    parsed_args["artist"] = author.get("name", None)
+                if parsed_args["artist_url"] is None:
+                    parsed_args["artist_url"] = author.get("url", None)
                 yield self.STATUS_PACK_UPDATE
             else:
                 yield self.STATUS_PACK_EXISTS
                 return
 
         yield self.STATUS_DOWNLOADING
-        converted_stickerset = await self.exporter.get_stickerset(pack_name)
-        yield self.STATUS_UPLOADING
+        with span(trace, "telegram_stickerset") as stickerset_span:
+            set_hash, documents = await self.exporter.get_stickerset_documents(pack_name)
+            stickerset_span["documents"] = len(documents)
 
         stickerset = MatrixStickerset(import_name, pack_name, parsed_args["rating"], {"name": parsed_args["artist"], "url": parsed_args["artist_url"]})
+        stickerset.set_telegram_hash(set_hash)
         json_stickerset = MauniumStickerset(import_name, pack_name, parsed_args["rating"], {"name": parsed_args["artist"], "url": parsed_args["artist_url"]}, self.room.room_id)
 
-        with tqdm(total=len(converted_stickerset)) as tqdm_object:
-            for sticker in converted_stickerset:
-                with tempfile.NamedTemporaryFile('w+b', delete=False) as file:
-                    file.write(sticker.image_data)
-                    hash = hashlib.md5(sticker.image_data).hexdigest()
-                    name = f"{pack_name}__{sticker.alt_text}__{os.path.basename(file.name)}"
+        # Same Telegram hash and pack metadata means the room already has exactly this pack
+        if stickerpack is not None and set_hash and stickerpack.get("pack", None) == stickerset.json()["pack"]:
+            yield self.STATUS_PACK_UNCHANGED
+            return
 
-                    sticker_mxc = None
-                    if stickerpack is not None and stickerpack.get('images', None) is not None:
-                        for stick in stickerpack['images'].values():
-                            if stick.get('hash', None) is not None and stick["hash"] == hash:
-                                sticker_mxc = stick["url"]
-                                break
+        yield self.STATUS_UPLOADING
 
+        existing_images = {}
+        existing_documents = {}
+        if stickerpack is not None and stickerpack.get('images', None) is not None:
+            for stick in stickerpack['images'].values():
+                # an image without url is left from a failed upload, it is uploaded again
+                if not stick.get('url', None):
+                    continue
+                if stick.get('hash', None) is not None:
+                    existing_images.setdefault(stick["hash"], stick["url"])
+                # stickers imported as a static fallback are converted again
+                if stick.get('tg_document_id', None) is not None and stick.get('info', None) is not None \
+                        and not stick.get('fallback', False):
+                    existing_documents[stick['tg_document_id']] = stick
+
+        # Stickers that are already in the pack are matched by their Telegram document and are not downloaded again
+        added_documents = [document for document in documents if str(document.id) not in existing_documents]
+        if stickerpack is not None:
+            removed = len(set(existing_documents) - {str(document.id) for document in documents})
+            logging.info(f"Updating {pack_name}: {len(added_documents)} added, {removed} removed, "
+                         f"{len(documents) - len(added_documents)} unchanged")
+
+        # Stickers are uploaded as soon as they are converted, while the rest of the pack is still being processed.
+        # Uploads run concurrently, but results are collected in the pack order so naming stays deterministic.
+        upload_semaphore = asyncio.Semaphore(self.upload_concurrency)
+        uploads = {}
+        converted = {}
+
+        async def _upload(image: Sticker, hash: str, document_id: int, kind: str):
+            try:
+                name = f"{pack_name}__{image.alt_text}__{hash}"
+                with span(trace, kind, document_id, bytes=len(image.image_data)):
+                    sticker_mxc = await upload_bytes(self.client, image.image_data, image.mimetype, name)
+                if self.media_index is not None and sticker_mxc:
+                    self.media_index.add(hash, sticker_mxc)
+                return sticker_mxc
+            finally:
+                upload_semaphore.release()
+
+        async def _schedule_upload(image: Sticker, document_id: int, kind: str = "upload") -> tuple[str, str]:
+            """Returns the image hash and its mxc uri, or None as the uri if the image is being uploaded"""
+            with span(trace, "hash", document_id, bytes=len(image.image_data)):
+                hash = hashlib.md5(image.image_data).hexdigest()
+
+            source = "room"
+            sticker_mxc = existing_images.get(hash, None)
+            if sticker_mxc is None and self.media_index is not None:
+                source = "media_index"
+                sticker_mxc = self.media_index.get(hash)
+
+            if sticker_mxc is None:
+                source = "in_flight"
+                if hash not in uploads:
+                    source = "uploaded"
+                    with span(trace, "upload_wait", document_id):
+                        await upload_semaphore.acquire()
+                    uploads[hash] = asyncio.ensure_future(_upload(image, hash, document_id, kind))
+            if trace is not None:
+                trace.sticker(document_id, **{f"{kind}_source": source})
+            return hash, sticker_mxc
+
+        with tqdm(total=len(added_documents)) as tqdm_object:
+            with span(trace, "stream", stickers=len(added_documents)):
+                async for sticker in self.exporter.stream_stickers(added_documents, trace):
+                    hash, sticker_mxc = await _schedule_upload(sticker, sticker.document_id)
+                    thumbnail_hash, thumbnail_mxc, thumbnail_info = None, None, None
+                    if sticker.thumbnail is not None:
+                        thumbnail_hash, thumbnail_mxc = await _schedule_upload(sticker.thumbnail, sticker.document_id,
+                                                                               "thumbnail_upload")
+                        thumbnail_info = {"w": sticker.thumbnail.width, "h": sticker.thumbnail.height,
+                                          "size": sticker.thumbnail.size, "mimetype": sticker.thumbnail.mimetype}
+                    # only the metadata is kept, the image data is released as soon as its upload is done
+                    info = {"w": sticker.width, "h": sticker.height, "size": sticker.size, "mimetype": sticker.mimetype}
+                    converted[sticker.document_id] = (sticker.fallback, info, hash, sticker_mxc,
+                                                      thumbnail_hash, thumbnail_mxc, thumbnail_info)
+                    tqdm_object.update(1)
+
+            fallbacks = 0
+            skipped = 0
+            for document in documents:
+                fallback = False
+                if str(document.id) in existing_documents:
+                    stick = existing_documents[str(document.id)]
+                    sticker_mxc, hash, info = stick["url"], stick.get("hash", ""), stick["info"]
+                elif document.id in converted:
+                    (fallback, info, hash, sticker_mxc,
+                     thumbnail_hash, thumbnail_mxc, thumbnail_info) = converted[document.id]
                     if sticker_mxc is None:
-                        sticker_mxc = await upload_image(self.client, file.name, name)
-                    file.close()
-                    os.unlink(file.name)
+                        sticker_mxc = await uploads[hash]
+                    if not sticker_mxc:
+                        # the upload failed, same as a failed download it is retried by the next update
+                        skipped += 1
+                        stickerset.set_telegram_hash(0)
+                        continue
+                    if thumbnail_hash is not None:
+                        if thumbnail_mxc is None:
+                            thumbnail_mxc = await uploads[thumbnail_hash]
+                        if thumbnail_mxc:
+                            info["thumbnail_url"] = thumbnail_mxc
+                            info["thumbnail_info"] = thumbnail_info
+                else:
+                    # failed to download or convert, keep the pack out of date so the next update retries it
+                    skipped += 1
+                    stickerset.set_telegram_hash(0)
+                    continue
 
-                stickerset.add_sticker(sticker_mxc, sticker.alt_text, hash)
+                alt_text = document_alt_text(document)
+                stickerset.add_sticker(sticker_mxc, alt_text, hash, document.id, info, fallback)
+                if fallback:
+                    fallbacks += 1
+                    # keep the pack out of date, so the next update converts it again
+                    stickerset.set_telegram_hash(0)
                 if parsed_args["json"]:
-                    json_stickerset.add_sticker(sticker_mxc, sticker.alt_text, sticker.width, sticker.height, sticker.size, sticker.mimetype)
-                tqdm_object.update(1)
+                    json_stickerset.add_sticker(sticker_mxc, alt_text, info["w"], info["h"], info["size"], info["mimetype"],
+                                                info.get("thumbnail_url", None), info.get("thumbnail_info", None))
+
+        if skipped:
+            logging.warning(f"{skipped} stickers of {pack_name} failed to download, convert or upload and were left out")
+            yield self.STATUS_STICKERS_SKIPPED
 
         if not stickerset.count():
             yield self.STATUS_PACK_EMPTY
             return
 
+        if fallbacks:
+            logging.warning(f"{fallbacks} stickers of {pack_name} were imported as a static first frame")
+            yield self.STATUS_CONVERSION_FALLBACK
+
         yield self.STATUS_UPDATING_ROOM_STATE
 
-        await upload_stickerpack(self.client, self.room.room_id, stickerset, pack_location)
+        with span(trace, "room_state"):
+            await upload_stickerpack(self.client, self.room.room_id, stickerset, pack_location)
 
         if parsed_args["json"]:
-            if not os.path.exists(f"{os.getcwd()}/data/stickersets/"):
-                os.mkdir(f"{os.getcwd()}/data/stickersets/")
-            with open(f"{os.getcwd()}/data/stickersets/" + json_stickerset.id + ".json", "w", encoding="utf-8") as f:
-                f.write(json.dumps(json_stickerset.json()))
+            with span(trace, "json"):
+                await asyncio.to_thread(save_stickerpack, f"{os.getcwd()}/data/stickersets", json_stickerset.id,
+                                        json_stickerset.json(), self.config.get('matrix_homeserver', None),
+                                        self.config['import']['json_gzip'])
 
         yield self.STATUS_OK
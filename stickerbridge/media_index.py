@@ -0,0 +1,60 @@
+import logging
+import sqlite3
+from typing import Union
+
+from nio import AsyncClient, JoinedRoomsResponse, RoomGetStateResponse
+
+
+class MediaIndex:
+    """Persistent map of converted sticker hashes to the mxc uris they were already uploaded as.
+
+    Shared between the bot and the cli, so identical stickers are uploaded to the homeserver only once."""
+
+    def __init__(self, filename: str):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS media (hash TEXT PRIMARY KEY, mxc TEXT NOT NULL)")
+        self.connection.commit()
+
+    def get(self, hash: str) -> Union[str, None]:
+        row = self.connection.execute("SELECT mxc FROM media WHERE hash = ?", (hash,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, hash: str, mxc_uri: str):
+        if not hash or not mxc_uri:
+            return
+        # the first upload of an image stays its mxc uri, an entry is never pointed somewhere else
+        self.connection.execute("INSERT OR IGNORE INTO media (hash, mxc) VALUES (?, ?)", (hash, mxc_uri))
+        self.connection.commit()
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM media").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+async def rebuild_media_index(client: AsyncClient, media_index: MediaIndex) -> int:
+    """Fill the index from the stickerpacks in every room the bot has joined, returns number of indexed stickers.
+
+    Only packs the bot has sent itself, with media on its own homeserver, are indexed. Anyone can set a pack
+    in a room the bot joined, and could otherwise map the hash of a popular sticker to their own media."""
+    joined_rooms = await client.joined_rooms()
+    if not isinstance(joined_rooms, JoinedRoomsResponse):
+        logging.error(f"Failed to get joined rooms: {joined_rooms}")
+        return 0
+
+    own_server = client.user.split(":", 1)[-1]
+    indexed = 0
+    for room_id in joined_rooms.rooms:
+        state = await client.room_get_state(room_id)
+        if not isinstance(state, RoomGetStateResponse):
+            logging.warning(f"Failed to get state of {room_id}: {state}")
+            continue
+        for event in state.events:
+            if event.get('type') != 'im.ponies.room_emotes' or event.get('sender') != client.user:
+                continue
+            for image in event.get('content', {}).get('images', {}).values():
+                if image.get('hash') and str(image.get('url', '')).startswith(f"mxc://{own_server}/"):
+                    media_index.add(image['hash'], image['url'])
+                    indexed += 1
+    return indexed
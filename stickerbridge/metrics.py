@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Callable, Union
+
+_registry = []
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: tuple, extra: dict = None) -> str:
+        labels = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not labels:
+            return ""
+        escaped = [(name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for name, value in labels]
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name}{self._format_labels(key)} {_format_value(value)}" for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self._samples())
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]):
+        """Compute the value when the metrics are collected, only for gauges without labels"""
+        self._function = function
+
+    def _samples(self) -> list[str]:
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        return super()._samples()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+        self._values[key] = (counts, total + value)
+
+    def _samples(self) -> list[str]:
+        samples = []
+        for key, (counts, total) in self._values.items():
+            for bound, count in zip(self.buckets, counts):
+                samples.append(f"{self.name}_bucket{self._format_labels(key, {'le': _format_value(bound)})} {count}")
+            samples.append(f"{self.name}_sum{self._format_labels(key)} {_format_value(total)}")
+            samples.append(f"{self.name}_count{self._format_labels(key)} {counts[-1]}")
+        return samples
+
+
+def _format_value(value: Union[int, float]) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+DOWNLOAD_SECONDS = Histogram("stickerbridge_download_seconds", "Time to download a sticker from Telegram")
+DOWNLOAD_BYTES = Counter("stickerbridge_download_bytes_total", "Bytes of stickers downloaded from Telegram")
+CONVERSION_SECONDS = Histogram("stickerbridge_conversion_seconds", "Time to convert a sticker, by the Telegram mimetype",
+                               ("mimetype",))
+CONVERSION_BYTES = Counter("stickerbridge_conversion_bytes_total", "Bytes of converted stickers, by the Telegram mimetype",
+                           ("mimetype",))
+CONVERSIONS = Counter("stickerbridge_conversions_total", "Converted stickers, by result: ok, fallback, unsupported or failed",
+                      ("result",))
+UPLOAD_SECONDS = Histogram("stickerbridge_upload_seconds", "Time to upload a file to the homeserver")
+UPLOAD_BYTES = Counter("stickerbridge_upload_bytes_total", "Bytes uploaded to the homeserver")
+IMPORTS = Counter("stickerbridge_import_status_total", "Statuses reported by stickerpack imports", ("status",))
+IMPORTS_IN_PROGRESS = Gauge("stickerbridge_imports_in_progress", "Stickerpack imports that have not finished yet")
+POOL_QUEUE_DEPTH = Gauge("stickerbridge_conversion_pool_queue_depth", "Conversion tasks waiting for a free worker")
+POOL_BUSY_WORKERS = Gauge("stickerbridge_conversion_pool_busy_workers", "Conversion workers running a task")
+SYNC_LAG = Gauge("stickerbridge_sync_lag_seconds", "Seconds since the last successful sync with the homeserver")
+EVENT_LOOP_LAG = Gauge("stickerbridge_event_loop_lag_seconds", "How late the event loop woke up a sleeping task")
+MATRIX_ERRORS = Counter("stickerbridge_matrix_errors_total", "Failed homeserver requests, by operation", ("operation",))
+TELEGRAM_ERRORS = Counter("stickerbridge_telegram_errors_total", "Failed Telegram requests, by operation", ("operation",))
+
+_last_sync = time.monotonic()
+SYNC_LAG.set_function(lambda: time.monotonic() - _last_sync)
+
+
+def sync_succeeded():
+    global _last_sync
+    _last_sync = time.monotonic()
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # headers are not used
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (ConnectionError, UnicodeDecodeError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _watch_event_loop(interval: float):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(0.0, loop.time() - started - interval))
+
+
+class MetricsServer:
+    """Serves the metrics over http on /metrics, so Prometheus can scrape them"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._server = None
+        self._watcher = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(_handle_request, self.host, self.port)
+        self._watcher = asyncio.ensure_future(_watch_event_loop(1))
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
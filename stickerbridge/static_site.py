@@ -0,0 +1,196 @@
+import hashlib
+import html
+import json
+import logging
+import math
+import os
+import re
+import shutil
+
+from file_utils import atomic_write
+from stickerpicker import INDEX_FILENAME
+
+# Bump when the generated pages change, so the next build renders every pack again
+SITE_VERSION = 1
+
+STYLE = """body{font-family:sans-serif;margin:2em auto;max-width:60em;padding:0 1em}
+.grid{display:flex;flex-wrap:wrap;gap:1em;list-style:none;padding:0}
+.grid li{width:8em;text-align:center;word-wrap:break-word}
+.grid img{width:8em;height:8em;object-fit:contain}
+nav{margin:1em 0}nav a{margin-right:1em}"""
+
+
+def _media_url(media_url: str, mxc_uri: str) -> str:
+    if not mxc_uri or not mxc_uri.startswith("mxc://"):
+        return mxc_uri or ""
+    return media_url + mxc_uri[len("mxc://"):]
+
+
+def _page(title: str, body: str, root: str) -> str:
+    return (f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>'
+            f'<meta name="viewport" content="width=device-width,initial-scale=1">'
+            f'<link rel="stylesheet" href="{root}style.css"></head>\n<body>\n{body}\n</body></html>\n')
+
+
+def _write_if_changed(filename: str, content: str) -> bool:
+    """Skip files which already have this content, so a deploy of the site only copies what changed"""
+    try:
+        with open(filename, "r", encoding="utf-8") as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    atomic_write(filename, content)
+    return True
+
+
+def _pack_entry(pack: dict, pack_id: str, media_url: str) -> dict:
+    """Compact summary of a pack for the index"""
+    stickers = pack.get("stickers", [])
+    preview = ""
+    if stickers:
+        info = stickers[0].get("info", {})
+        preview = _media_url(media_url, info.get("thumbnail_url") or stickers[0].get("url"))
+    author = pack.get("author") or {}
+    return {
+        "id": pack_id,
+        "title": pack.get("title") or pack_id,
+        "author": author.get("name") if isinstance(author, dict) else author,
+        "rating": pack.get("rating"),
+        "stickers": len(stickers),
+        "preview": preview,
+    }
+
+
+def _render_pack(pack: dict, entry: dict, media_url: str) -> tuple[str, str]:
+    """Gallery page and compact json of a pack"""
+    stickers = []
+    items = []
+    for sticker in pack.get("stickers", []):
+        info = sticker.get("info", {})
+        url = _media_url(media_url, sticker.get("url"))
+        thumbnail = _media_url(media_url, info.get("thumbnail_url")) or url
+        stickers.append({"body": sticker.get("body", ""), "url": url, "thumbnail": thumbnail,
+                         "w": info.get("w"), "h": info.get("h")})
+        items.append(f'<li><a href="{html.escape(url)}"><img loading="lazy" src="{html.escape(thumbnail)}" '
+                     f'alt="{html.escape(sticker.get("body", ""))}"></a></li>')
+
+    header = [f"<h1>{html.escape(entry['title'])}</h1>"]
+    details = [f"{entry['stickers']} stickers"]
+    if entry["author"]:
+        details.append(f"by {html.escape(str(entry['author']))}")
+    if entry["rating"]:
+        details.append(f"rating: {html.escape(str(entry['rating']))}")
+    header.append(f"<p>{', '.join(details)}</p>")
+    body = '<nav><a href="../../index.html">All packs</a><a href="pack.json">json</a></nav>\n' + "\n".join(header) + \
+           '\n<ul class="grid">\n' + "\n".join(items) + "\n</ul>"
+    data = dict(entry, stickers=stickers)
+    return _page(entry["title"], body, "../../"), json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def _index_filename(page: int) -> str:
+    return "index.html" if page == 1 else f"index-{page}.html"
+
+
+def _render_index(entries: list[dict], page: int, pages: int) -> tuple[str, str]:
+    """One page of the html index and of the paginated json index"""
+    items = []
+    for entry in entries:
+        link = f"packs/{html.escape(entry['id'])}/index.html"
+        items.append(f'<li><a href="{link}"><img loading="lazy" src="{html.escape(entry["preview"])}" alt="">'
+                     f'<br>{html.escape(entry["title"])}</a><br>{entry["stickers"]} stickers</li>')
+    navigation = []
+    if page > 1:
+        navigation.append(f'<a href="{_index_filename(page - 1)}">Previous</a>')
+    navigation.append(f"Page {page} of {pages}")
+    if page < pages:
+        navigation.append(f'<a href="{_index_filename(page + 1)}">Next</a>')
+    nav = f"<nav>{' '.join(navigation)}</nav>"
+    body = f"<h1>Stickerpacks</h1>\n{nav}\n" + '<ul class="grid">\n' + "\n".join(items) + f"\n</ul>\n{nav}"
+    data = {"page": page, "pages": pages, "packs": entries}
+    return _page("Stickerpacks", body, ""), json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def _load_manifest(filename: str) -> dict:
+    try:
+        with open(filename, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def build_site(source: str, output: str, media_url: str, page_size: int = 100) -> dict[str, int]:
+    """Generate a static gallery of the maunium json files in source.
+
+    Only packs whose json changed since the last build are rendered again, the manifest in the output directory
+    keeps what was built from which file. The index is split into pages of page_size packs, as html and json,
+    and only index pages whose content changed are written.
+    Returns counts of built, unchanged and removed packs, and of written index files."""
+    page_size = max(1, page_size)
+    manifest_filename = os.path.join(output, "manifest.json")
+    manifest = _load_manifest(manifest_filename)
+    settings = {"version": SITE_VERSION, "media_url": media_url}
+    known = manifest.get("packs", {}) if manifest.get("settings") == settings else {}
+
+    stats = {"built": 0, "unchanged": 0, "removed": 0, "index_files": 0}
+    packs = {}
+    filenames = sorted(os.listdir(source)) if os.path.isdir(source) else []
+    for filename in filenames:
+        pack_id = filename[:-len(".json")]
+        # index.json is the pack list of the stickerpicker, not a pack
+        if filename == INDEX_FILENAME or not filename.endswith(".json") or not re.fullmatch(r'\w[\w.-]*', pack_id):
+            continue
+        path = os.path.join(source, filename)
+        stat = os.stat(path)
+        record = known.get(pack_id, None)
+        if record is not None and record["mtime_ns"] == stat.st_mtime_ns and record["size"] == stat.st_size:
+            packs[pack_id] = record
+            stats["unchanged"] += 1
+            continue
+
+        with open(path, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if record is not None and record["sha256"] == digest:
+            packs[pack_id] = dict(record, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            stats["unchanged"] += 1
+            continue
+        try:
+            pack = json.loads(content)
+        except ValueError as e:
+            logging.warning(f"Skipping {path}, it is not valid json: {e}")
+            continue
+        if not isinstance(pack, dict) or not isinstance(pack.get("stickers", None), list):
+            continue
+
+        entry = _pack_entry(pack, pack_id, media_url)
+        page, data = _render_pack(pack, entry, media_url)
+        _write_if_changed(os.path.join(output, "packs", pack_id, "index.html"), page)
+        _write_if_changed(os.path.join(output, "packs", pack_id, "pack.json"), data)
+        packs[pack_id] = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": digest, "entry": entry}
+        stats["built"] += 1
+
+    for pack_id in set(manifest.get("packs", {})) - set(packs):
+        shutil.rmtree(os.path.join(output, "packs", pack_id), ignore_errors=True)
+        stats["removed"] += 1
+
+    entries = sorted((record["entry"] for record in packs.values()), key=lambda entry: (entry["title"].lower(), entry["id"]))
+    pages = max(1, math.ceil(len(entries) / page_size))
+    for page in range(1, pages + 1):
+        index_page, index_data = _render_index(entries[(page - 1) * page_size:page * page_size], page, pages)
+        stats["index_files"] += _write_if_changed(os.path.join(output, _index_filename(page)), index_page)
+        stats["index_files"] += _write_if_changed(os.path.join(output, "index", f"{page}.json"), index_data)
+    # pages left over from a build with more packs
+    old_pages = manifest.get("pages", 0) if isinstance(manifest.get("pages", 0), int) else 0
+    for page in range(pages + 1, old_pages + 1):
+        for filename in [_index_filename(page), os.path.join("index", f"{page}.json")]:
+            try:
+                os.unlink(os.path.join(output, filename))
+            except OSError:
+                pass
+
+    _write_if_changed(os.path.join(output, "style.css"), STYLE + "\n")
+    os.makedirs(output, exist_ok=True)
+    atomic_write(manifest_filename, json.dumps({"settings": settings, "pages": pages, "packs": packs}))
+    return stats
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Union
+
+from file_utils import atomic_write
+from sticker_types import Sticker
+
+
+class StickerCache:
+    """On-disk cache of converted stickers, keyed by the Telegram document id and the converter parameters.
+
+    Every entry is the converted image, its optional thumbnail and a small json with their dimensions.
+    Reading an entry bumps its modification time, which is used to evict the least recently used
+    entries once the cache grows over max_size bytes."""
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, document_id: int, params: str) -> str:
+        key = hashlib.sha256(f"{document_id}:{params}".encode()).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def get(self, document_id: int, params: str, alt_text: str) -> Union[Sticker, None]:
+        path = self._path(document_id, params)
+        try:
+            with open(path + ".json", "r") as f:
+                meta = json.load(f)
+            with open(path + ".bin", "rb") as f:
+                data = f.read()
+            thumbnail_data = None
+            if meta.get("thumbnail", None) is not None:
+                with open(path + ".thumb", "rb") as f:
+                    thumbnail_data = f.read()
+            for extension in self._extensions(meta):
+                os.utime(path + extension)
+        except (OSError, ValueError):
+            return None
+
+        sticker = Sticker(data, alt_text, meta["width"], meta["height"], len(data), meta["mimetype"], document_id)
+        if thumbnail_data is not None:
+            sticker.thumbnail = Sticker(thumbnail_data, alt_text, meta["thumbnail"]["width"], meta["thumbnail"]["height"],
+                                        len(thumbnail_data), meta["thumbnail"]["mimetype"])
+        return sticker
+
+    def put(self, document_id: int, params: str, sticker: Sticker):
+        path = self._path(document_id, params)
+        meta = {"width": sticker.width, "height": sticker.height, "mimetype": sticker.mimetype, "thumbnail": None}
+        files = [(".bin", sticker.image_data)]
+        if sticker.thumbnail is not None:
+            meta["thumbnail"] = {"width": sticker.thumbnail.width, "height": sticker.thumbnail.height,
+                                 "mimetype": sticker.thumbnail.mimetype}
+            files.append((".thumb", sticker.thumbnail.image_data))
+        # the json is written last, an entry without it is never read
+        files.append((".json", json.dumps(meta)))
+
+        try:
+            for extension, content in files:
+                atomic_write(path + extension, content)
+        except OSError as e:
+            logging.warning(f"Failed to cache sticker {document_id}: {e}")
+            return
+
+        if self._size is None:
+            self._size = self._entries_size()
+        else:
+            self._size += sum(len(content) for _, content in files)
+        if self._size > self.max_size:
+            self._evict()
+
+    @staticmethod
+    def _extensions(meta: dict) -> list[str]:
+        if meta.get("thumbnail", None) is not None:
+            return [".bin", ".thumb", ".json"]
+        return [".bin", ".json"]
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        """List cached entries as (last use, total size, path without extension)"""
+        entries = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                path, extension = os.path.splitext(entry.path)
+                if extension not in (".bin", ".thumb", ".json"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                last_use, size = entries.get(path, (0, 0))
+                entries[path] = (max(last_use, stat.st_mtime), size + stat.st_size)
+        return [(last_use, size, path) for path, (last_use, size) in entries.items()]
+
+    def _entries_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            # the json goes first, so a half removed entry is never read
+            for extension in (".json", ".bin", ".thumb"):
+                try:
+                    os.unlink(path + extension)
+                except OSError:
+                    pass
+            total -= size
+        self._size = total
@@ -1,14 +1,20 @@
 class Sticker:
     """Custom type for easier transfering sticker data between functions and classes with simple lists and returns"""
-    def __init__(self, image_data, alt_text: str, width: int, height: int, size: int, mimetype: str):
+    def __init__(self, image_data, alt_text: str, width: int, height: int, size: int, mimetype: str,
+                 document_id: int = None):
         self.image_data = image_data
         self.alt_text = alt_text
+        self.document_id = document_id
 
         self.width = width
         self.height = height
         self.mimetype = mimetype
         self.size = size
 
+        self.thumbnail: Sticker = None
+        # set when the animation could not be converted in time and its first frame is used instead
+        self.fallback = False
+
 
 class MatrixStickerset:
     def __init__(self, import_name: str, pack_name: str, rating: str, author: str):
@@ -22,7 +28,8 @@ class MatrixStickerset:
             "images": {}
         }
 
-    def add_sticker(self, mxc_uri: str, alt_text: str, hash=""):
+    def add_sticker(self, mxc_uri: str, alt_text: str, hash="", document_id: int = None, info: dict = None,
+                    fallback: bool = False):
         if alt_text in self._content['images']:
             duplicate_counter = 1
             alt_text = alt_text + '-' + str(duplicate_counter)
@@ -34,6 +41,15 @@ class MatrixStickerset:
             "usage": ["sticker"],
             "hash": hash
         }
+        if document_id is not None:
+            self._content['images'][alt_text]["tg_document_id"] = str(document_id)
+        if info is not None:
+            self._content['images'][alt_text]["info"] = info
+        if fallback:
+            self._content['images'][alt_text]["fallback"] = True
+
+    def set_telegram_hash(self, hash: int):
+        self._content['pack']['tg_hash'] = hash
 
     def count(self):
         return len(self._content['images'])
@@ -57,21 +73,24 @@ class MauniumStickerset:
         self.room_id = room_id
         self.stickers = []
 
-    def add_sticker(self, mxc_uri: str, alt_text: str, width: int, height: int, size: int, mimetype: str):
-        self.stickers.append(
-            {
-                "body": alt_text,
-                "info": {
-                    "h": height,
-                    "w": width,
-                    "size": size,
-                    "mimetype": mimetype,
-                },
-                "msgtype": "m.sticker",
-                "url": mxc_uri,
-                "id": mxc_uri.split("/")[-1]
-            }
-        )
+    def add_sticker(self, mxc_uri: str, alt_text: str, width: int, height: int, size: int, mimetype: str,
+                    thumbnail_url: str = None, thumbnail_info: dict = None):
+        sticker = {
+            "body": alt_text,
+            "info": {
+                "h": height,
+                "w": width,
+                "size": size,
+                "mimetype": mimetype,
+            },
+            "msgtype": "m.sticker",
+            "url": mxc_uri,
+            "id": mxc_uri.split("/")[-1]
+        }
+        if thumbnail_url:
+            sticker["info"]["thumbnail_url"] = thumbnail_url
+            sticker["info"]["thumbnail_info"] = thumbnail_info
+        self.stickers.append(sticker)
 
     def json(self):
         return {
@@ -0,0 +1,94 @@
+import gzip
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Union
+
+from file_utils import atomic_write
+
+try:
+    import fcntl
+except ImportError:
+    # not on POSIX, only imports of this process are kept apart then
+    fcntl = None
+
+INDEX_FILENAME = "index.json"
+
+# imports in this process update the index from threads, the file lock keeps the bot and the cli apart
+_index_lock = threading.Lock()
+# directories whose index got the pack files that were there before it was maintained
+_seeded_directories = set()
+
+
+@contextmanager
+def _locked(directory: str):
+    with _index_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(directory, ".index.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _write(filename: str, content: str, gzip_copy: bool):
+    """Write the file atomically, with a pre-compressed copy next to it for web servers that serve those"""
+    atomic_write(filename, content)
+    if gzip_copy:
+        atomic_write(filename + ".gz", gzip.compress(content.encode("utf-8"), mtime=0))
+    elif os.path.exists(filename + ".gz"):
+        # an outdated copy would be served instead of the new file
+        os.unlink(filename + ".gz")
+
+
+def _load_index(filename: str) -> dict:
+    try:
+        with open(filename, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return {"packs": []}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Rebuilding the stickerpicker index, {filename} could not be read: {e}")
+        return {"packs": []}
+    if not isinstance(index, dict) or not isinstance(index.get("packs", None), list):
+        return {"packs": []}
+    return index
+
+
+def update_index(directory: str, pack_filename: str = None, homeserver_url: Union[str, None] = None,
+                 gzip_copy: bool = False) -> bool:
+    """Add or replace one pack of the index.json that maunium's stickerpicker loads, and remove packs whose
+    file is gone. The rest of the index is kept as it is, returns whether the index changed.
+    On the first update of a directory, or when it has no index, pack files missing from the index are added."""
+    filename = os.path.join(directory, INDEX_FILENAME)
+    with _locked(directory):
+        index = _load_index(filename)
+        packs = [pack for pack in index["packs"]
+                 if isinstance(pack, str) and os.path.exists(os.path.join(directory, pack))]
+        if directory not in _seeded_directories or not os.path.exists(filename):
+            packs.extend(name for name in sorted(os.listdir(directory))
+                         if name.endswith(".json") and name != INDEX_FILENAME and name not in packs)
+            _seeded_directories.add(directory)
+        if pack_filename is not None and pack_filename not in packs:
+            packs.append(pack_filename)
+        updated = dict(index, packs=packs)
+        if homeserver_url:
+            updated["homeserver_url"] = homeserver_url
+        if updated == index and os.path.exists(filename) and os.path.exists(filename + ".gz") == gzip_copy:
+            return False
+        _write(filename, json.dumps(updated, ensure_ascii=False), gzip_copy)
+        return True
+
+
+def save_stickerpack(directory: str, pack_id: str, content: dict, homeserver_url: Union[str, None] = None,
+                     gzip_copy: bool = False):
+    """Write the maunium json of a pack and list it in the index"""
+    os.makedirs(directory, exist_ok=True)
+    pack_filename = pack_id + ".json"
+    _write(os.path.join(directory, pack_filename), json.dumps(content), gzip_copy)
+    update_index(directory, pack_filename, homeserver_url, gzip_copy)
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import os
+from typing import Union
+
+from file_utils import atomic_write
+
+
+class SyncTokenStore:
+    """Keeps the sync token (next_batch) on disk, so a restarted bot continues syncing where it stopped.
+
+    Tokens of a busy sync loop are coalesced: the file is written at most once every interval seconds,
+    in a thread and atomically, and the last token is written on close."""
+
+    def __init__(self, filename: str, interval: float):
+        self.filename = filename
+        self.interval = max(0, interval or 0)
+        self._token = None
+        self._written = None
+        self._changed = asyncio.Event()
+        self._task = None
+        self._writing = None
+
+    def load(self) -> Union[str, None]:
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename, "r") as next_batch_token:
+            self._written = self._token = next_batch_token.read()
+        return self._token
+
+    def update(self, token: str):
+        self._token = token
+        self._changed.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            # shielded, so close() can wait for a write in progress instead of racing with it
+            self._writing = asyncio.ensure_future(self._write())
+            await asyncio.shield(self._writing)
+            await asyncio.sleep(self.interval)
+
+    async def _write(self):
+        token = self._token
+        if token is None or token == self._written:
+            return
+        try:
+            await asyncio.to_thread(atomic_write, self.filename, token)
+        except OSError as e:
+            logging.warning(f"Failed to save the sync token: {e}")
+            return
+        self._written = token
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._writing is not None:
+            await self._writing
+        await self._write()
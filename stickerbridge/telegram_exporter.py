@@ -1,5 +1,18 @@
-from multiprocessing import Pool
-from typing import List
+import asyncio
+import base64
+import glob
+import gzip
+import json
+import math
+import os
+import re
+import shutil
+import signal
+import tempfile
+import time
+from contextlib import contextmanager
+import multiprocessing
+from typing import AsyncIterator, List, Union
 
 import logging
 from tqdm.auto import tqdm
@@ -7,37 +20,88 @@ from tqdm.auto import tqdm
 from lottie.importers import importers
 from lottie.exporters import exporters
 from telethon import TelegramClient
-from telethon.errors import StickersetInvalidError
+from telethon.errors import FileReferenceExpiredError, StickersetInvalidError
+from telethon.extensions import BinaryReader
 from telethon.tl.functions.messages import GetStickerSetRequest
 from telethon.tl.types import InputStickerSetShortName
+from telethon.tl.types.messages import StickerSetNotModified
 
 from io import BytesIO
 from PIL import Image
 
+import metrics
+from file_utils import atomic_write
+from import_trace import ImportTrace, span
+from sticker_cache import StickerCache
 from sticker_types import Sticker
 
+STICKER_SIZE = 256
+ANIMATION_FRAME_RATE = 24
 
-def _convert_image(data: bytes):
+
+class ConversionTimeout(Exception):
+    pass
+
+
+def _raise_conversion_timeout(signum, frame):
+    raise ConversionTimeout()
+
+
+@contextmanager
+def _time_budget(seconds: float):
+    """Interrupt the conversion running in this worker once it takes longer than seconds"""
+    if not seconds or not hasattr(signal, 'setitimer'):
+        yield
+        return
+    previous_handler = signal.signal(signal.SIGALRM, _raise_conversion_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+RESAMPLING_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+
+def _conversion_params(mime_type: str, resample: str = "lanczos", thumbnail_size: int = 0) -> str:
+    """Describe the converter output for a Telegram mime type, used as a part of the cache key"""
+    if mime_type == 'image/webp':
+        return f"image/png:{STICKER_SIZE}:{resample}:{thumbnail_size}"
+    if mime_type == 'application/x-tgsticker':
+        return f"image/webp:{STICKER_SIZE}:{ANIMATION_FRAME_RATE}"
+    return mime_type
+
+
+def _convert_image(data: bytes, resample: str = "lanczos", thumbnail_size: int = 0):
     image: Image.Image = Image.open(BytesIO(data)).convert("RGBA")
+    image.thumbnail((STICKER_SIZE, STICKER_SIZE), RESAMPLING_FILTERS[resample])
     new_file = BytesIO()
     image.save(new_file, "png")
     w, h = image.size
-    if w > 256 or h > 256:
-        if w > h:
-            h = int(h / (w / 256))
-            w = 256
-        else:
-            w = int(w / (h / 256))
-            h = 256
-    return new_file.getvalue(), w, h, "image/png"
+
+    thumbnail = None
+    if thumbnail_size and (w > thumbnail_size or h > thumbnail_size):
+        image.thumbnail((thumbnail_size, thumbnail_size), RESAMPLING_FILTERS[resample])
+        thumbnail_file = BytesIO()
+        image.save(thumbnail_file, "png")
+        thumbnail = (thumbnail_file.getvalue(), image.size[0], image.size[1])
+    return new_file.getvalue(), w, h, "image/png", thumbnail
 
 
-def _convert_animation(data: bytes, width=256, height=0):
+def _load_animation(data: bytes, width=STICKER_SIZE, height=0):
     importer = importers.get_from_extension('tgs')
-    exporter = exporters.get('webp')
     an = importer.process(BytesIO(data))
 
-    an.frame_rate = 24
+    an.frame_rate = ANIMATION_FRAME_RATE
 
     if width or height:
         if not width:
@@ -45,59 +109,546 @@ def _convert_animation(data: bytes, width=256, height=0):
         if not height:
             height = an.height * width / an.width
         an.scale(width, height)
+    return an, width, height
+
+
+def _convert_animation(data: bytes, width=STICKER_SIZE, height=0):
+    exporter = exporters.get('webp')
+    an, width, height = _load_animation(data, width, height)
 
     out = BytesIO()
     exporter.process(an, out)
-    return out.getvalue(), width, height, "image/webp"
+    return out.getvalue(), width, height, "image/webp", None
+
+
+def _render_first_frame(data: bytes, width=STICKER_SIZE, height=0):
+    from lottie.exporters.cairo import export_png
+
+    an, width, height = _load_animation(data, width, height)
+    out = BytesIO()
+    export_png(an, out, int(an.in_point))
+    return out.getvalue(), width, height, "image/png", None
+
+
+def _animation_frame_count(data: bytes) -> int:
+    """Read the frame range straight from the gzipped lottie json, without parsing the whole animation"""
+    animation = json.loads(gzip.decompress(data))
+    return int(animation["op"]) - int(animation["ip"]) + 1
 
 
-def _process_sticker(document) -> Sticker:
-    alt: str = document.attributes[1].alt
-    if document.mime_type == 'image/webp':
-        data, width, height, mime_type = _convert_image(document.downloaded_data_)
-    elif document.mime_type == 'application/x-tgsticker':
-        data, width, height, mime_type = _convert_animation(document.downloaded_data_)
-    else:
+def _render_animation_frames(data: bytes, start: int, stop: int, time_budget: float = 0) -> list[bytes]:
+    """Render frames in_point + start up to in_point + stop of an animation to png"""
+    from lottie.exporters.cairo import PngRenderer
+
+    with _time_budget(time_budget):
+        an, _, _ = _load_animation(data)
+        first = int(an.in_point)
+        frames = []
+        with PngRenderer(an, 96) as renderer:
+            for i in range(first + start, min(first + stop, int(an.out_point) + 1)):
+                file = BytesIO()
+                renderer.serialize(i, file)
+                frames.append(file.getvalue())
+    return frames
+
+
+def _assemble_animation(frames: list[bytes]) -> bytes:
+    """Encode rendered frames the same way the lottie webp exporter does"""
+    images = [Image.open(BytesIO(frame)) for frame in frames]
+    out = BytesIO()
+    images[0].save(
+        out,
+        format='WebP',
+        append_images=images[1:],
+        save_all=True,
+        duration=int(round(1000 / ANIMATION_FRAME_RATE)),
+        loop=0,
+        background=(0, 0, 0, 0),
+        lossless=False,
+        quality=80,
+        method=0,
+    )
+    return out.getvalue()
+
+
+def _init_worker():
+    """Warm up a conversion worker, so the first sticker it gets does not pay for loading lottie and Pillow plugins"""
+    importers.get_from_extension('tgs')
+    exporters.get('webp')
+    Image.init()
+
+
+def document_alt_text(document) -> str:
+    return document.attributes[1].alt
+
+
+def _convert_sticker_data(data: bytes, mime_type: str, document_id: int, resample: str = "lanczos",
+                          thumbnail_size: int = 0, time_budget: float = 0, first_frame: bool = False):
+    """Returns converted data, width, height, mime type, thumbnail and whether it is a fallback,
+    or None for unsupported mime types. Animations that take too long, or with first_frame, become their first frame."""
+    if mime_type == 'image/webp':
+        with _time_budget(time_budget):
+            return *_convert_image(data, resample, thumbnail_size), False
+    if mime_type == 'application/x-tgsticker':
+        if not first_frame:
+            try:
+                with _time_budget(time_budget):
+                    return *_convert_animation(data), False
+            except ConversionTimeout:
+                logging.warning(f"Animated sticker {document_id} took longer than {time_budget}s, using its first frame")
+        with _time_budget(time_budget):
+            return *_render_first_frame(data), True
+    return None
+
+
+def _process_sticker(document, resample: str = "lanczos", thumbnail_size: int = 0, time_budget: float = 0,
+                     first_frame: bool = False) -> Sticker:
+    alt: str = document_alt_text(document)
+    converted = _convert_sticker_data(document.downloaded_data_, document.mime_type, document.id, resample,
+                                      thumbnail_size, time_budget, first_frame)
+    if converted is None:
         return
-    return Sticker(data, alt, width, height, document.size, mime_type)
+    data, width, height, mime_type, thumbnail, fallback = converted
+    sticker = Sticker(data, alt, width, height, len(data), mime_type, document.id)
+    sticker.fallback = fallback
+    if thumbnail is not None:
+        thumbnail_data, thumbnail_width, thumbnail_height = thumbnail
+        sticker.thumbnail = Sticker(thumbnail_data, alt, thumbnail_width, thumbnail_height, len(thumbnail_data), "image/png")
+    return sticker
+
+
+def _process_fallback(document, time_budget: float = 0) -> Sticker:
+    """Static png from the first frame of an animation that could not be converted in time"""
+    return _process_sticker(document, time_budget=time_budget, first_frame=True)
+
+
+def _write_file(path: str, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _process_spooled_sticker(path: str, mime_type: str, document_id: int, resample: str = "lanczos",
+                             thumbnail_size: int = 0, time_budget: float = 0, first_frame: bool = False):
+    """Convert a download spooled to path, writing the result to path.out and the thumbnail to path.thumb.
+
+    Only the path and the metadata go through the pool, returns width, height, mime type,
+    thumbnail width and height or None, and whether it is a fallback"""
+    converted = _convert_sticker_data(_read_file(path), mime_type, document_id, resample, thumbnail_size, time_budget,
+                                      first_frame)
+    if converted is None:
+        return None
+    data, width, height, mime_type, thumbnail, fallback = converted
+    _write_file(path + '.out', data)
+    thumbnail_dimensions = None
+    if thumbnail is not None:
+        _write_file(path + '.thumb', thumbnail[0])
+        thumbnail_dimensions = thumbnail[1:]
+    return width, height, mime_type, thumbnail_dimensions, fallback
+
+
+def _spooled_animation_frame_count(path: str) -> int:
+    return _animation_frame_count(_read_file(path))
+
+
+def _render_spooled_animation_frames(path: str, start: int, stop: int, time_budget: float = 0) -> list[str]:
+    """Render frames of a spooled animation to png files next to it, returns their paths"""
+    frames = _render_animation_frames(_read_file(path), start, stop, time_budget)
+    paths = []
+    for index, frame in enumerate(frames, start):
+        paths.append(f"{path}.frame{index}")
+        _write_file(paths[-1], frame)
+    return paths
+
+
+def _remove_files(paths: list[str]):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _assemble_spooled_animation(frame_paths: list[str], output_path: str) -> tuple[int, int]:
+    """Encode the spooled frames to output_path and remove them, returns the animation size"""
+    frames = [_read_file(frame_path) for frame_path in frame_paths]
+    for frame_path in frame_paths:
+        os.unlink(frame_path)
+    _write_file(output_path, _assemble_animation(frames))
+    return Image.open(BytesIO(frames[0])).size
 
 
 class TelegramExporter:
-    def __init__(self, api_id: int, api_hash: str, bot_token: str, secrets_filename: str):
+    def __init__(self, api_id: int, api_hash: str, bot_token: str, secrets_filename: str,
+                 download_concurrency: int = 4, conversion_workers: int = None,
+                 conversion_max_tasks_per_child: int = None, stream_queue_size: int = None,
+                 cache: StickerCache = None, stickersets_directory: str = None,
+                 resample: str = "lanczos", thumbnail_size: int = 0, frame_chunk_size: int = 0,
+                 time_budget: float = 0, spool_directory: str = None):
         self.api_id = api_id
         self.api_hash = api_hash
         self.bot_token = bot_token
         self.secrets_filename = secrets_filename
+        self.download_concurrency = max(1, download_concurrency or 1)
+        self.stream_queue_size = stream_queue_size or self.download_concurrency * 2
+        self.conversion_workers = conversion_workers
+        self.conversion_max_tasks_per_child = conversion_max_tasks_per_child
+
+        self.cache = cache
+        self.stickersets_directory = stickersets_directory
+        if resample not in RESAMPLING_FILTERS:
+            raise ValueError(f'Unknown resampling filter "{resample}", use one of: {", ".join(RESAMPLING_FILTERS)}')
+        self.resample = resample
+        self.thumbnail_size = thumbnail_size or 0
+        self.frame_chunk_size = frame_chunk_size or 0
+        self.time_budget = time_budget or 0
+        self.pool = None
+        self._pool_tasks = 0
+        # downloads go to files in here instead of memory, and workers get their paths instead of the data
+        self.spool_directory = spool_directory
+        self._spool = None
 
         self.client = TelegramClient(self.secrets_filename, self.api_id, self.api_hash, system_version="4.16.30-vxStickerBridge")
 
+    def start_pool(self):
+        if self.pool is None:
+            # with max_tasks_per_child workers are replaced while telethon and the thread pool are running,
+            # forking this multithreaded process then could deadlock the new worker, so workers start from a clean process
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.pool = multiprocessing.get_context(method).Pool(
+                processes=self.conversion_workers, initializer=_init_worker,
+                maxtasksperchild=self.conversion_max_tasks_per_child)
+
     async def connect(self):
+        # Workers are started before the Telegram connection is opened and are reused by every import
+        self.start_pool()
         await self.client.start(bot_token=self.bot_token)
 
     async def close(self):
         await self.client.disconnect()
+        if self.pool is not None:
+            self.pool.close()
+            await asyncio.to_thread(self.pool.join)
+            self.pool = None
+        if self._spool is not None:
+            shutil.rmtree(self._spool, ignore_errors=True)
+            self._spool = None
 
-    async def get_stickerset(self, pack_name: str) -> list[Sticker]:
-        logging.getLogger('telethon').setLevel(logging.WARNING)
+    def _update_pool_metrics(self):
+        workers = self.conversion_workers or os.cpu_count() or 1
+        metrics.POOL_BUSY_WORKERS.set(min(self._pool_tasks, workers))
+        metrics.POOL_QUEUE_DEPTH.set(max(0, self._pool_tasks - workers))
 
-        result: List[Sticker] = list()
+    async def _run_in_pool(self, func, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _resolve(setter, value):
+            if not future.done():
+                setter(value)
 
+        self._pool_tasks += 1
+        self._update_pool_metrics()
         try:
-            sticker_set = await self.client(GetStickerSetRequest(InputStickerSetShortName(short_name=pack_name), hash=0))
+            self.pool.apply_async(
+                func, args,
+                callback=lambda result: loop.call_soon_threadsafe(_resolve, future.set_result, result),
+                error_callback=lambda error: loop.call_soon_threadsafe(_resolve, future.set_exception, error),
+            )
+            return await future
+        finally:
+            self._pool_tasks -= 1
+            self._update_pool_metrics()
+
+    def _known_stickerset_filename(self, pack_name: str) -> Union[str, None]:
+        if self.stickersets_directory is None or not re.fullmatch(r'\w+', pack_name):
+            return None
+        return os.path.join(self.stickersets_directory, pack_name.lower() + '.json')
+
+    def _load_known_stickerset(self, pack_name: str) -> tuple[int, Union[list, None]]:
+        filename = self._known_stickerset_filename(pack_name)
+        if filename is None or not os.path.exists(filename):
+            return 0, None
+        try:
+            with open(filename, 'r') as f:
+                known = json.load(f)
+            documents = [BinaryReader(base64.b64decode(document)).tgread_object() for document in known['documents']]
+        except Exception as e:
+            logging.warning(f"Failed to read known stickerset {pack_name}: {e}")
+            return 0, None
+        return known['hash'], documents
+
+    def _save_known_stickerset(self, pack_name: str, set_hash: int, documents: list):
+        filename = self._known_stickerset_filename(pack_name)
+        if filename is None:
+            return
+        os.makedirs(self.stickersets_directory, exist_ok=True)
+        known = {
+            'hash': set_hash,
+            'documents': [base64.b64encode(bytes(document)).decode() for document in documents],
+        }
+        atomic_write(filename, json.dumps(known))
+
+    async def get_stickerset_documents(self, pack_name: str) -> tuple[int, list]:
+        """Get the stickerset hash and documents, Telegram is asked to send them only if the set changed since the last call"""
+        logging.getLogger('telethon').setLevel(logging.WARNING)
+
+        known_hash, known_documents = await asyncio.to_thread(self._load_known_stickerset, pack_name)
+        try:
+            sticker_set = await self.client(GetStickerSetRequest(InputStickerSetShortName(short_name=pack_name),
+                                                                 hash=known_hash if known_documents is not None else 0))
         except StickersetInvalidError:
-            return result  # return empty on fail
+            return 0, []  # return empty on fail
+        except Exception:
+            metrics.TELEGRAM_ERRORS.inc(operation="get_stickerset")
+            raise
 
-        downloaded_documents = []
+        if isinstance(sticker_set, StickerSetNotModified):
+            logging.debug(f"Stickerset {pack_name} was not modified since the last import")
+            return known_hash, known_documents
 
-        with tqdm(total=len(sticker_set.documents)) as tqdm_object:
-            for document_data in sticker_set.documents:
-                document_data.downloaded_data_ = await self.client.download_media(document_data, file=bytes)
-                downloaded_documents.append(document_data)
-                tqdm_object.update(1)
+        await asyncio.to_thread(self._save_known_stickerset, pack_name, sticker_set.set.hash, sticker_set.documents)
+        return sticker_set.set.hash, sticker_set.documents
+
+    async def _refresh_file_reference(self, document_data, refreshed_sets: dict):
+        """Documents of a not modified stickerset come from disk and their file reference may have expired"""
+        input_stickerset = document_data.attributes[1].stickerset
+        if input_stickerset.id not in refreshed_sets:
+            refreshed_sets[input_stickerset.id] = asyncio.ensure_future(
+                self.client(GetStickerSetRequest(input_stickerset, hash=0)))
+        sticker_set = await refreshed_sets[input_stickerset.id]
+        await asyncio.to_thread(self._save_known_stickerset, sticker_set.set.short_name, sticker_set.set.hash,
+                                sticker_set.documents)
+        for document in sticker_set.documents:
+            if document.id == document_data.id:
+                document_data.file_reference = document.file_reference
+
+    def _spool_file(self, document_data) -> str:
+        if self._spool is None:
+            os.makedirs(self.spool_directory, exist_ok=True)
+            # every exporter has its own directory, so the bot and the cli can share the spool directory
+            self._spool = tempfile.mkdtemp(prefix='spool-', dir=self.spool_directory)
+        fd, path = tempfile.mkstemp(prefix=f"{document_data.id}-", dir=self._spool)
+        os.close(fd)
+        return path
+
+    @staticmethod
+    def _remove_spooled(document_data):
+        path = getattr(document_data, 'spooled_path_', None)
+        if path is None:
+            return
+        for spooled in glob.glob(glob.escape(path) + '*'):
+            try:
+                os.unlink(spooled)
+            except OSError:
+                pass
+        document_data.spooled_path_ = None
 
-        logging.info(f"Processing downloaded stickers...")
-        pool = Pool()
-        # result = pool.map(_process_sticker, downloaded_documents)
-        result = list(tqdm(pool.imap(_process_sticker, downloaded_documents), total=len(downloaded_documents)))
+    async def _download_media(self, document_data, refreshed_sets: dict, file):
+        try:
+            return await self.client.download_media(document_data, file=file)
+        except FileReferenceExpiredError:
+            await self._refresh_file_reference(document_data, refreshed_sets)
+            return await self.client.download_media(document_data, file=file)
+
+    async def _download_document(self, document_data, refreshed_sets: dict):
+        """Download the document to downloaded_data_, or to the file at spooled_path_ when spooling"""
+        started = time.monotonic()
+        try:
+            if self.spool_directory is not None:
+                document_data.spooled_path_ = self._spool_file(document_data)
+                await self._download_media(document_data, refreshed_sets, document_data.spooled_path_)
+                size = os.path.getsize(document_data.spooled_path_)
+            else:
+                document_data.downloaded_data_ = await self._download_media(document_data, refreshed_sets, bytes)
+                size = len(document_data.downloaded_data_)
+        except Exception as e:
+            logging.error(f"Failed to download sticker {document_data.id}: {e}")
+            metrics.TELEGRAM_ERRORS.inc(operation="download")
+            self._remove_spooled(document_data)
+            return None
+        metrics.DOWNLOAD_SECONDS.observe(time.monotonic() - started)
+        metrics.DOWNLOAD_BYTES.inc(size)
+        return document_data
+
+    async def _convert_spooled(self, document_data, first_frame: bool = False) -> Union[Sticker, None]:
+        path = document_data.spooled_path_
+        result = await self._run_in_pool(_process_spooled_sticker, path, document_data.mime_type, document_data.id,
+                                         self.resample, self.thumbnail_size, self.time_budget, first_frame)
+        if result is None:
+            return None
+        width, height, mime_type, thumbnail_dimensions, fallback = result
+
+        alt = document_alt_text(document_data)
+        data = await asyncio.to_thread(_read_file, path + '.out')
+        sticker = Sticker(data, alt, width, height, len(data), mime_type, document_data.id)
+        sticker.fallback = fallback
+        if thumbnail_dimensions is not None:
+            thumbnail_data = await asyncio.to_thread(_read_file, path + '.thumb')
+            sticker.thumbnail = Sticker(thumbnail_data, alt, *thumbnail_dimensions, len(thumbnail_data), "image/png")
+        return sticker
+
+    async def _convert_animation_in_parallel(self, document_data) -> Union[Sticker, None]:
+        """Split rendering of a long animation across the pool, returns None for animations that fit one chunk"""
+        spooled = getattr(document_data, 'spooled_path_', None)
+        try:
+            # decompressing and parsing the lottie json takes a while for long animations, so not on the event loop
+            if spooled is not None:
+                frame_count = await asyncio.to_thread(_spooled_animation_frame_count, spooled)
+            else:
+                frame_count = await asyncio.to_thread(_animation_frame_count, document_data.downloaded_data_)
+        except Exception:
+            return None
+        if frame_count <= self.frame_chunk_size:
+            return None
+
+        chunks = math.ceil(frame_count / self.frame_chunk_size)
+        # every chunk is awaited even when one fails, a worker still rendering would write its frames after cleanup
+        rendered = await asyncio.gather(*[
+            self._run_in_pool(_render_spooled_animation_frames if spooled is not None else _render_animation_frames,
+                              spooled if spooled is not None else document_data.downloaded_data_,
+                              chunk * self.frame_chunk_size, (chunk + 1) * self.frame_chunk_size, self.time_budget)
+            for chunk in range(chunks)
+        ], return_exceptions=True)
+        errors = [result for result in rendered if isinstance(result, BaseException)]
+        if errors:
+            if spooled is not None:
+                await asyncio.to_thread(_remove_files, [frame for chunk in rendered
+                                                        if not isinstance(chunk, BaseException) for frame in chunk])
+            if not any(isinstance(error, ConversionTimeout) for error in errors):
+                raise errors[0]
+            logging.warning(f"Animated sticker {document_data.id} took longer than {self.time_budget}s, using its first frame")
+            if spooled is not None:
+                return await self._convert_spooled(document_data, first_frame=True)
+            return await self._run_in_pool(_process_fallback, document_data, self.time_budget)
+        frames = [frame for chunk in rendered for frame in chunk]
+        if spooled is not None:
+            # frames are files here, they are encoded by a worker straight to the spooled output
+            width, height = await self._run_in_pool(_assemble_spooled_animation, frames, spooled + '.out')
+            data = await asyncio.to_thread(_read_file, spooled + '.out')
+        else:
+            data = await self._run_in_pool(_assemble_animation, frames)
+            width, height = Image.open(BytesIO(frames[0])).size
+        return Sticker(data, document_alt_text(document_data), width, height, len(data), "image/webp",
+                       document_data.id)
+
+    async def _convert_document(self, document_data, trace_span: dict = None):
+        """Convert a downloaded document, trace_span gets the conversion path that was taken"""
+        started = time.monotonic()
+        path = "animated" if document_data.mime_type == 'application/x-tgsticker' else "static"
+        try:
+            sticker = None
+            if self.frame_chunk_size and document_data.mime_type == 'application/x-tgsticker':
+                sticker = await self._convert_animation_in_parallel(document_data)
+                if sticker is not None:
+                    path = "animated_chunked"
+            if sticker is None and getattr(document_data, 'spooled_path_', None) is not None:
+                sticker = await self._convert_spooled(document_data)
+            elif sticker is None:
+                sticker = await self._run_in_pool(_process_sticker, document_data, self.resample, self.thumbnail_size,
+                                                  self.time_budget)
+        except Exception as e:
+            logging.error(f"Failed to convert sticker {document_data.id}: {e}")
+            metrics.CONVERSIONS.inc(result="failed")
+            if trace_span is not None:
+                trace_span["path"] = "failed"
+            return None
+        if sticker is None:
+            metrics.CONVERSIONS.inc(result="unsupported")
+            if trace_span is not None:
+                trace_span["path"] = "unsupported"
+            return None
+        metrics.CONVERSION_SECONDS.observe(time.monotonic() - started, mimetype=document_data.mime_type)
+        metrics.CONVERSION_BYTES.inc(len(sticker.image_data), mimetype=document_data.mime_type)
+        metrics.CONVERSIONS.inc(result="fallback" if sticker.fallback else "ok")
+        if trace_span is not None:
+            trace_span["path"] = "fallback" if sticker.fallback else path
+        return sticker
+
+    async def stream_stickers(self, documents: list, trace: ImportTrace = None) -> AsyncIterator[Sticker]:
+        """Yield converted stickers in the order of documents, each one as soon as it is ready.
 
+        Documents are downloaded and converted ahead of the consumer, but at most
+        stream_queue_size of them are in flight, so a slow consumer holds the pipeline back."""
+        semaphore = asyncio.Semaphore(self.download_concurrency)
+        queue = asyncio.Queue(maxsize=self.stream_queue_size)
+        refreshed_sets = {}
+
+        async def _prepare(document_data):
+            document_id = document_data.id
+            if trace is not None:
+                trace.sticker(document_id, mimetype=document_data.mime_type, telegram_size=document_data.size)
+
+            if self.cache is not None:
+                params = _conversion_params(document_data.mime_type, self.resample, self.thumbnail_size)
+                with span(trace, "cache_lookup", document_id) as cache_span:
+                    sticker = await asyncio.to_thread(self.cache.get, document_data.id, params,
+                                                      document_alt_text(document_data))
+                    cache_span["hit"] = sticker is not None
+                if sticker is not None:
+                    if trace is not None:
+                        trace.sticker(document_id, path="cache", converted_bytes=len(sticker.image_data))
+                    return sticker
+
+            with span(trace, "download_wait", document_id):
+                await semaphore.acquire()
+            try:
+                with span(trace, "download", document_id, bytes=document_data.size):
+                    document_data = await self._download_document(document_data, refreshed_sets)
+            finally:
+                semaphore.release()
+            if document_data is None:
+                return None
+            try:
+                with span(trace, "convert", document_id) as convert_span:
+                    sticker = await self._convert_document(document_data, convert_span)
+                    if sticker is not None:
+                        convert_span["bytes"] = len(sticker.image_data)
+            finally:
+                # the download is not needed anymore, so a pack is never held in memory or on disk as a whole
+                document_data.downloaded_data_ = None
+                self._remove_spooled(document_data)
+            if trace is not None:
+                trace.sticker(document_id, path=convert_span["path"],
+                              converted_bytes=len(sticker.image_data) if sticker is not None else 0)
+
+            # fallbacks are not cached, so the next import tries to convert them again
+            if sticker is not None and not sticker.fallback and self.cache is not None:
+                with span(trace, "cache_store", document_id):
+                    await asyncio.to_thread(self.cache.put, document_data.id, params, sticker)
+            return sticker
+
+        async def _feed():
+            for document_data in documents:
+                await queue.put(asyncio.ensure_future(_prepare(document_data)))
+            await queue.put(None)
+
+        feeder = asyncio.ensure_future(_feed())
+        try:
+            while True:
+                task = await queue.get()
+                if task is None:
+                    break
+                sticker = await task
+                if sticker is not None:
+                    yield sticker
+        finally:
+            feeder.cancel()
+            while not queue.empty():
+                task = queue.get_nowait()
+                if task is not None:
+                    task.cancel()
+
+    async def get_stickerset(self, pack_name: str) -> list[Sticker]:
+        _, documents = await self.get_stickerset_documents(pack_name)
+
+        result: List[Sticker] = list()
+        with tqdm(total=len(documents)) as tqdm_object:
+            async for sticker in self.stream_stickers(documents):
+                result.append(sticker)
+                tqdm_object.update(1)
         return result